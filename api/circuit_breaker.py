@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Circuit breaker cho từng endpoint của API HUTECH
+"""
+
+import logging
+import time
+from typing import Dict, Any
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+class CircuitOpenError(aiohttp.ClientError):
+    """Lỗi khi circuit breaker đang mở và request bị từ chối ngay lập tức."""
+
+    def __init__(self, name: str, retry_after: float):
+        self.name = name
+        self.retry_after = retry_after
+        super().__init__(f"Hệ thống HUTECH đang tạm thời gián đoạn, vui lòng thử lại sau {int(retry_after) + 1} giây.")
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5, recovery_timeout: float = 30.0, half_open_max_calls: int = 1):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._half_open_calls = 0
+
+        # Thống kê phục vụ giám sát
+        self.total_successes = 0
+        self.total_failures = 0
+        self.total_rejected = 0
+
+    def retry_after(self) -> float:
+        """Số giây còn lại trước khi breaker cho phép request thử (half-open)."""
+        if self.state != self.OPEN:
+            return 0.0
+        return max(0.0, self.recovery_timeout - (time.monotonic() - self.opened_at))
+
+    def before_request(self) -> None:
+        """
+        Kiểm tra breaker trước khi gửi request.
+
+        Raises:
+            CircuitOpenError: Nếu breaker đang mở hoặc đã đủ số request thử ở trạng thái half-open.
+        """
+        if self.state == self.OPEN:
+            if self.retry_after() > 0:
+                self.total_rejected += 1
+                raise CircuitOpenError(self.name, self.retry_after())
+            self.state = self.HALF_OPEN
+            self._half_open_calls = 0
+            logger.info(f"Circuit breaker '{self.name}' chuyển sang HALF_OPEN.")
+
+        if self.state == self.HALF_OPEN:
+            if self._half_open_calls >= self.half_open_max_calls:
+                self.total_rejected += 1
+                raise CircuitOpenError(self.name, self.recovery_timeout)
+            self._half_open_calls += 1
+
+    def record_success(self) -> None:
+        """Ghi nhận một request thành công."""
+        self.total_successes += 1
+        self.consecutive_failures = 0
+        if self.state == self.HALF_OPEN:
+            self.state = self.CLOSED
+            self._half_open_calls = 0
+            logger.info(f"Circuit breaker '{self.name}' đã đóng lại (CLOSED).")
+
+    def record_failure(self) -> None:
+        """Ghi nhận một request thất bại (lỗi kết nối, timeout hoặc 5xx)."""
+        self.total_failures += 1
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning(f"Circuit breaker '{self.name}' MỞ sau {self.consecutive_failures} lỗi liên tiếp.")
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+            self._half_open_calls = 0
+
+    def release(self) -> None:
+        """Trả lại lượt thử half-open khi request bị hủy mà không có kết quả."""
+        if self.state == self.HALF_OPEN and self._half_open_calls > 0:
+            self._half_open_calls -= 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Trạng thái hiện tại của breaker."""
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "retry_after": round(self.retry_after(), 1),
+            "successes": self.total_successes,
+            "failures": self.total_failures,
+            "rejected": self.total_rejected
+        }
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Giới hạn số request đồng thời đến API HUTECH, tự điều chỉnh theo kiểu AIMD
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict, Any, Optional
+
+import aiohttp
+
+from utils import deadline
+
+logger = logging.getLogger(__name__)
+
+class ConcurrencyLimitError(aiohttp.ClientError):
+    """Lỗi khi chờ quá lâu để có lượt gửi request đến HUTECH."""
+
+    def __init__(self, queue_timeout: float):
+        super().__init__(f"Hệ thống HUTECH đang quá tải (đã chờ {queue_timeout:g} giây), vui lòng thử lại sau.")
+
+class AdaptiveConcurrencyLimiter:
+    def __init__(self, initial_limit: int, min_limit: int, max_limit: int, latency_threshold: float,
+                 queue_timeout: float, backoff_ratio: float = 0.5, decrease_cooldown: float = 1.0):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_threshold = latency_threshold
+        self.queue_timeout = queue_timeout
+        self.backoff_ratio = backoff_ratio
+        self.decrease_cooldown = decrease_cooldown
+
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.in_flight = 0
+        # Hàng đợi riêng theo mức ưu tiên (giá trị nhỏ hơn được đánh thức trước)
+        self._waiters: Dict[int, Deque[asyncio.Future]] = {}
+        self._last_decrease = 0.0
+
+        # Thống kê phục vụ giám sát
+        self.total_rejected = 0
+
+    @property
+    def current_limit(self) -> int:
+        """Giới hạn hiện tại (số nguyên) được áp dụng."""
+        return max(self.min_limit, int(self.limit))
+
+    @asynccontextmanager
+    async def acquire(self, priority: int = 0) -> AsyncIterator[None]:
+        """
+        Chiếm một lượt gửi request, chờ tối đa queue_timeout giây.
+
+        Args:
+            priority: Mức ưu tiên khi phải xếp hàng (giá trị nhỏ hơn được phục vụ trước)
+
+        Raises:
+            ConcurrencyLimitError: Nếu không có lượt trống trong thời gian chờ.
+        """
+        await self._acquire(priority)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def on_sample(self, latency: float, success: bool) -> None:
+        """
+        Điều chỉnh giới hạn theo kết quả của một request (AIMD).
+
+        Args:
+            latency: Thời gian xử lý request (giây)
+            success: Request có thành công hay không
+        """
+        if success and latency <= self.latency_threshold:
+            # Tăng cộng: +1 cho mỗi "cửa sổ" request thành công
+            self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+            self._wake_waiters()
+            return
+
+        # Giảm nhân, tối đa một lần mỗi decrease_cooldown giây để tránh sụp về min khi có loạt lỗi đồng thời
+        now = time.monotonic()
+        if now - self._last_decrease < self.decrease_cooldown:
+            return
+        self._last_decrease = now
+        old_limit = self.current_limit
+        self.limit = max(float(self.min_limit), self.limit * self.backoff_ratio)
+        logger.warning(f"Giảm giới hạn request đồng thời đến HUTECH: {old_limit} -> {self.current_limit} (latency={latency:.2f}s, success={success}).")
+
+    async def _acquire(self, priority: int) -> None:
+        if self.in_flight < self.current_limit and not self._has_waiters_before(priority):
+            self.in_flight += 1
+            return
+
+        # Không chờ quá thời gian còn lại của update đang xử lý
+        queue_timeout = self.queue_timeout
+        left = deadline.remaining()
+        if left is not None:
+            queue_timeout = max(0.0, min(queue_timeout, left))
+
+        fut = asyncio.get_running_loop().create_future()
+        queue = self._waiters.setdefault(priority, deque())
+        queue.append(fut)
+        try:
+            await asyncio.wait_for(fut, timeout=queue_timeout)
+        except asyncio.TimeoutError:
+            if fut.done() and not fut.cancelled():
+                self._release()
+            self.total_rejected += 1
+            raise ConcurrencyLimitError(self.queue_timeout)
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self._release()
+            raise
+        finally:
+            try:
+                queue.remove(fut)
+            except ValueError:
+                pass
+
+    def _has_waiters_before(self, priority: int) -> bool:
+        """Có request nào cùng hoặc cao hơn mức ưu tiên đang xếp hàng không."""
+        return any(queue for p, queue in self._waiters.items() if p <= priority)
+
+    def _next_waiter(self) -> Optional[asyncio.Future]:
+        for priority in sorted(self._waiters):
+            queue = self._waiters[priority]
+            while queue:
+                fut = queue.popleft()
+                if not fut.done():
+                    return fut
+        return None
+
+    def _release(self) -> None:
+        self.in_flight -= 1
+        self._wake_waiters()
+
+    def _wake_waiters(self) -> None:
+        while self.in_flight < self.current_limit:
+            fut = self._next_waiter()
+            if fut is None:
+                break
+            self.in_flight += 1
+            fut.set_result(None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Trạng thái hiện tại của limiter."""
+        return {
+            "limit": self.current_limit,
+            "in_flight": self.in_flight,
+            "queued": sum(len(queue) for queue in self._waiters.values()),
+            "rejected": self.total_rejected
+        }
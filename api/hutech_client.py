@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+HTTP client dùng chung để gọi API HUTECH
+"""
+
+import asyncio
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Any, Optional
+
+import aiohttp
+
+from config.config import Config
+from api.circuit_breaker import CircuitBreaker, CircuitOpenError
+from api.concurrency_limiter import AdaptiveConcurrencyLimiter, ConcurrencyLimitError
+from api.rate_limiter import RedisRateLimiter, Priority, RateLimitError, current_priority
+from api.retry import RetryBudget, LatencyTracker, backoff_delay
+from utils import deadline
+
+logger = logging.getLogger(__name__)
+
+class HutechClient:
+    def __init__(self, cache_manager):
+        self.config = Config()
+        self.session: Optional[aiohttp.ClientSession] = None
+        # Mỗi endpoint có một circuit breaker riêng, dùng chung một limiter cho toàn bộ upstream
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.limiter = AdaptiveConcurrencyLimiter(
+            initial_limit=self.config.HUTECH_LIMIT_INITIAL,
+            min_limit=self.config.HUTECH_LIMIT_MIN,
+            max_limit=self.config.HUTECH_LIMIT_MAX,
+            latency_threshold=self.config.HUTECH_LIMIT_LATENCY_THRESHOLD,
+            queue_timeout=self.config.HUTECH_LIMIT_QUEUE_TIMEOUT
+        )
+        # Giới hạn tốc độ dùng chung giữa các instance qua Redis
+        self.rate_limiter = RedisRateLimiter(cache_manager)
+        # Retry/hedge cho các endpoint chỉ đọc, giới hạn bởi retry budget
+        self.retry_budget = RetryBudget(
+            ratio=self.config.HUTECH_RETRY_BUDGET_RATIO,
+            min_per_second=self.config.HUTECH_RETRY_BUDGET_MIN_PER_SECOND,
+            max_tokens=self.config.HUTECH_RETRY_BUDGET_MAX
+        )
+        self.latency_trackers: Dict[str, LatencyTracker] = {}
+        self.hedged_requests = 0
+
+    async def connect(self):
+        """Khởi tạo ClientSession dùng chung với connector giữ kết nối (keep-alive)."""
+        if not self.session:
+            try:
+                connector = aiohttp.TCPConnector(
+                    limit=self.config.HUTECH_HTTP_POOL_SIZE,
+                    limit_per_host=self.config.HUTECH_HTTP_POOL_SIZE_PER_HOST,
+                    ttl_dns_cache=self.config.HUTECH_HTTP_DNS_CACHE_TTL,
+                    keepalive_timeout=self.config.HUTECH_HTTP_KEEPALIVE_TIMEOUT,
+                    enable_cleanup_closed=True
+                )
+                self.session = aiohttp.ClientSession(
+                    base_url=self.config.HUTECH_API_BASE_URL,
+                    connector=connector,
+                    # Không dùng timeout mặc định 5 phút của aiohttp
+                    timeout=aiohttp.ClientTimeout(
+                        total=self.config.HUTECH_HTTP_TIMEOUT,
+                        connect=self.config.HUTECH_HTTP_CONNECT_TIMEOUT
+                    )
+                )
+                logger.info("Đã tạo HTTP client dùng chung cho API HUTECH.")
+            except Exception as e:
+                logger.error(f"Không thể tạo HTTP client cho API HUTECH: {e}")
+                raise
+
+    async def close(self):
+        """Đóng ClientSession và giải phóng các kết nối đang giữ."""
+        if self.session:
+            await self.session.close()
+            self.session = None
+            logger.info("Đã đóng HTTP client của API HUTECH.")
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """Lấy ClientSession dùng chung."""
+        if not self.session:
+            raise ConnectionError("HTTP client HUTECH chưa được khởi tạo. Hãy gọi connect() trước.")
+        return self.session
+
+    @asynccontextmanager
+    async def request(self, method: str, endpoint: str, priority: Optional[Priority] = None, **kwargs) -> AsyncIterator[aiohttp.ClientResponse]:
+        """
+        Gửi request đến API HUTECH qua session dùng chung, đi qua circuit breaker
+        của endpoint, rate limiter dùng chung và limiter số request đồng thời.
+        Với các endpoint chỉ đọc (HUTECH_RETRYABLE_ENDPOINTS), lỗi tạm thời được retry
+        với backoff ngẫu nhiên và có thể gửi thêm hedged request khi phản hồi chậm.
+
+        Args:
+            method: HTTP method (GET, POST, ...)
+            endpoint: Đường dẫn endpoint (ví dụ: Config.HUTECH_TKB_ENDPOINT)
+            priority: Mức ưu tiên của request (mặc định lấy theo context hiện tại)
+            **kwargs: Các tham số truyền thẳng cho aiohttp (headers, json, params, ...).
+                Nếu không truyền timeout, dùng timeout riêng của endpoint, giới hạn bởi deadline của update.
+
+        Yields:
+            Response của aiohttp với body đã được đọc sẵn.
+
+        Raises:
+            CircuitOpenError: Nếu breaker của endpoint đang mở.
+            RateLimitError: Nếu không có token trong thời gian chờ của mức ưu tiên.
+            ConcurrencyLimitError: Nếu chờ lượt gửi request quá lâu.
+            asyncio.TimeoutError: Nếu request vượt quá timeout của endpoint hoặc deadline của update.
+        """
+        # Kiểm tra deadline trước khi chiếm breaker/limiter
+        deadline.budget(self._endpoint_timeout(endpoint))
+        if priority is None:
+            priority = current_priority.get()
+
+        if endpoint not in self.config.HUTECH_RETRYABLE_ENDPOINTS:
+            response = await self._attempt(method, endpoint, priority, kwargs)
+        else:
+            response = await self._request_with_retries(method, endpoint, priority, kwargs)
+
+        try:
+            yield response
+        finally:
+            response.release()
+
+    async def _request_with_retries(self, method: str, endpoint: str, priority: Priority, kwargs: Dict[str, Any]) -> aiohttp.ClientResponse:
+        """Gửi request chỉ đọc, retry lỗi tạm thời trong giới hạn của retry budget và deadline."""
+        self.retry_budget.deposit()
+        attempt = 1
+        while True:
+            try:
+                response = await self._hedged_attempt(method, endpoint, priority, kwargs)
+                if response.status < 500:
+                    return response
+                error = None
+            except (CircuitOpenError, RateLimitError, ConcurrencyLimitError, deadline.DeadlineExceeded):
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                response = None
+                error = e
+
+            delay = backoff_delay(attempt, self.config.HUTECH_RETRY_BASE_DELAY, self.config.HUTECH_RETRY_MAX_DELAY)
+            left = deadline.remaining()
+            if (attempt >= self.config.HUTECH_RETRY_MAX_ATTEMPTS
+                    or (left is not None and delay >= left)
+                    or not self.retry_budget.withdraw()):
+                if response is not None:
+                    return response
+                raise error
+
+            reason = f"HTTP {response.status}" if response is not None else type(error).__name__
+            logger.warning(f"Retry lần {attempt} cho {endpoint} sau {delay:.2f}s ({reason}).")
+            if response is not None:
+                response.release()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _hedged_attempt(self, method: str, endpoint: str, priority: Priority, kwargs: Dict[str, Any]) -> aiohttp.ClientResponse:
+        """
+        Gửi một lượt request; nếu bật hedging và lượt này chậm hơn p95 quan sát được
+        của endpoint, gửi thêm một request song song và lấy kết quả về trước.
+        """
+        hedge_delay = None
+        if self.config.HUTECH_HEDGE_ENABLED:
+            hedge_delay = self._get_latency_tracker(endpoint).percentile(0.95)
+        if hedge_delay is None:
+            return await self._attempt(method, endpoint, priority, kwargs)
+
+        tasks = {asyncio.create_task(self._attempt(method, endpoint, priority, kwargs))}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+            if not done and self.retry_budget.withdraw():
+                self.hedged_requests += 1
+                logger.info(f"Gửi hedged request cho {endpoint} (đã chờ quá p95 = {hedge_delay:.2f}s).")
+                tasks.add(asyncio.create_task(self._attempt(method, endpoint, priority, kwargs)))
+
+            fallback = None
+            error = None
+            pending = tasks
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                    elif task.result().status < 500:
+                        return task.result()
+                    else:
+                        fallback = task.result()
+            if fallback is not None:
+                return fallback
+            raise error
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None:
+                    # Giải phóng response của lượt request không được dùng
+                    task.result().release()
+
+    async def _attempt(self, method: str, endpoint: str, priority: Priority, kwargs: Dict[str, Any]) -> aiohttp.ClientResponse:
+        """Một lượt gửi request: breaker, rate limit, lượt đồng thời, gửi và đọc toàn bộ body."""
+        session = self.get_session()
+        breaker = self._get_breaker(endpoint)
+        breaker.before_request()
+
+        attempt_start = time.monotonic()
+        request_kwargs = dict(kwargs)
+        try:
+            await self.rate_limiter.acquire(priority)
+            async with self.limiter.acquire(priority):
+                if "timeout" not in request_kwargs:
+                    request_kwargs["timeout"] = aiohttp.ClientTimeout(
+                        total=deadline.budget(self._endpoint_timeout(endpoint)),
+                        connect=self.config.HUTECH_HTTP_CONNECT_TIMEOUT
+                    )
+                start = time.monotonic()
+                try:
+                    async with session.request(method, endpoint, **request_kwargs) as response:
+                        # Đọc body ngay để giải phóng lượt đồng thời trước khi handler xử lý dữ liệu
+                        await response.read()
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    self.limiter.on_sample(time.monotonic() - start, False)
+                    raise
+                # Lỗi 4xx là lỗi của request (token, dữ liệu), không phải do upstream gặp sự cố
+                success = response.status < 500
+                self.limiter.on_sample(time.monotonic() - start, success)
+        except (asyncio.CancelledError, RateLimitError, ConcurrencyLimitError, deadline.DeadlineExceeded):
+            breaker.release()
+            raise
+        except Exception:
+            breaker.record_failure()
+            raise
+
+        if success:
+            breaker.record_success()
+            # Độ trễ tính cả thời gian chờ rate limit/lượt đồng thời, giống thời gian chờ trước khi hedge
+            self._get_latency_tracker(endpoint).record(time.monotonic() - attempt_start)
+        else:
+            breaker.record_failure()
+        return response
+
+    def _endpoint_timeout(self, endpoint: str) -> float:
+        """Timeout (giây) của một endpoint."""
+        return self.config.HUTECH_ENDPOINT_TIMEOUTS.get(endpoint, self.config.HUTECH_HTTP_TIMEOUT)
+
+    def _get_latency_tracker(self, endpoint: str) -> LatencyTracker:
+        """Lấy (hoặc tạo mới) bộ theo dõi độ trễ cho một endpoint."""
+        tracker = self.latency_trackers.get(endpoint)
+        if tracker is None:
+            tracker = LatencyTracker(min_samples=self.config.HUTECH_HEDGE_MIN_SAMPLES)
+            self.latency_trackers[endpoint] = tracker
+        return tracker
+
+    def _get_breaker(self, endpoint: str) -> CircuitBreaker:
+        """Lấy (hoặc tạo mới) circuit breaker cho một endpoint."""
+        breaker = self.breakers.get(endpoint)
+        if breaker is None:
+            breaker = CircuitBreaker(
+                name=endpoint,
+                failure_threshold=self.config.HUTECH_BREAKER_FAILURE_THRESHOLD,
+                recovery_timeout=self.config.HUTECH_BREAKER_RECOVERY_TIMEOUT
+            )
+            self.breakers[endpoint] = breaker
+        return breaker
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Trạng thái của limiter, retry budget và các circuit breaker, phục vụ giám sát."""
+        return {
+            "limiter": self.limiter.get_stats(),
+            "rate_limiter": self.rate_limiter.get_stats(),
+            "retry_budget": self.retry_budget.get_stats(),
+            "hedged_requests": self.hedged_requests,
+            "breakers": {endpoint: breaker.get_stats() for endpoint, breaker in self.breakers.items()}
+        }
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Giới hạn tốc độ gọi API HUTECH dùng chung giữa các instance bot (token bucket trên Redis)
+"""
+
+import asyncio
+import logging
+import random
+import time
+from contextvars import ContextVar
+from enum import IntEnum
+from typing import Dict, Any
+
+import aiohttp
+
+from config.config import Config
+from utils import deadline
+
+logger = logging.getLogger(__name__)
+
+class Priority(IntEnum):
+    """Mức ưu tiên của request đến HUTECH (giá trị nhỏ hơn được ưu tiên hơn)."""
+    CRITICAL = 0      # Gửi mã điểm danh
+    INTERACTIVE = 1   # Lệnh/callback người dùng đang chờ
+    BACKGROUND = 2    # Làm mới cache nền, tải danh sách sinh viên
+
+# Mức ưu tiên mặc định cho các request trong context hiện tại (tác vụ nền đặt BACKGROUND)
+current_priority: ContextVar[Priority] = ContextVar("hutech_request_priority", default=Priority.INTERACTIVE)
+
+class RateLimitError(aiohttp.ClientError):
+    """Lỗi khi chờ quá lâu để có token gọi HUTECH."""
+
+    def __init__(self, priority: Priority):
+        self.priority = priority
+        super().__init__("Hệ thống đang nhận quá nhiều yêu cầu đến HUTECH, vui lòng thử lại sau ít phút.")
+
+# Token bucket: nạp lại theo thời gian Redis (đồng bộ giữa các instance),
+# mỗi mức ưu tiên phải chừa lại `reserve` token cho các mức ưu tiên cao hơn.
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local reserve = tonumber(ARGV[3])
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(data[1]) or capacity
+local ts = tonumber(data[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+local wait = 0
+if tokens - reserve >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+else
+    wait = (1 + reserve - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+return {allowed, tostring(wait)}
+"""
+
+class RedisRateLimiter:
+    def __init__(self, cache_manager, key: str = "ratelimit:hutech"):
+        self.cache_manager = cache_manager
+        self.config = Config()
+        self.key = key
+        self.enabled = self.config.HUTECH_RATE_LIMIT_ENABLED
+
+        # Số token phải chừa lại và thời gian chờ tối đa cho từng mức ưu tiên
+        self.reserves = {
+            Priority.CRITICAL: 0,
+            Priority.INTERACTIVE: self.config.HUTECH_RATE_RESERVE_CRITICAL,
+            Priority.BACKGROUND: self.config.HUTECH_RATE_RESERVE_CRITICAL + self.config.HUTECH_RATE_RESERVE_INTERACTIVE
+        }
+        self.max_waits = {
+            Priority.CRITICAL: self.config.HUTECH_RATE_MAX_WAIT_CRITICAL,
+            Priority.INTERACTIVE: self.config.HUTECH_RATE_MAX_WAIT_INTERACTIVE,
+            Priority.BACKGROUND: self.config.HUTECH_RATE_MAX_WAIT_BACKGROUND
+        }
+
+        # Thống kê phục vụ giám sát
+        self.granted: Dict[str, int] = {p.name: 0 for p in Priority}
+        self.rejected: Dict[str, int] = {p.name: 0 for p in Priority}
+        self.redis_errors = 0
+
+        # Script token bucket được đăng ký một lần cho mỗi Redis client (tránh tạo Script và tính SHA1 mỗi request)
+        self._script = None
+        self._script_client = None
+
+    def _get_script(self):
+        r = self.cache_manager.get_redis_client()
+        if self._script is None or self._script_client is not r:
+            self._script = r.register_script(TOKEN_BUCKET_SCRIPT)
+            self._script_client = r
+        return self._script
+
+    async def acquire(self, priority: Priority) -> None:
+        """
+        Chờ đến khi có token cho mức ưu tiên đã cho.
+
+        Args:
+            priority: Mức ưu tiên của request
+
+        Raises:
+            RateLimitError: Nếu không có token trong thời gian chờ tối đa của mức ưu tiên.
+        """
+        if not self.enabled:
+            return
+        if not self.cache_manager.is_redis_available():
+            # Redis đang gián đoạn: không chờ timeout cho mỗi request, bỏ qua giới hạn như khi gặp lỗi
+            self.redis_errors += 1
+            return
+
+        # Không chờ quá thời gian còn lại của update đang xử lý
+        max_wait = self.max_waits[priority]
+        left = deadline.remaining()
+        if left is not None:
+            max_wait = max(0.0, min(max_wait, left))
+        wait_until = time.monotonic() + max_wait
+        while True:
+            try:
+                script = self._get_script()
+                # Qua redis_execute: có timeout và Redis bị treo sẽ làm mở breaker thay vì chặn mọi request HUTECH
+                allowed, wait = await self.cache_manager.redis_execute(
+                    script,
+                    keys=[self.key],
+                    args=[self.config.HUTECH_RATE_LIMIT, self.config.HUTECH_RATE_BURST, self.reserves[priority]]
+                )
+            except deadline.DeadlineExceeded:
+                raise
+            except Exception as e:
+                # Không để lỗi Redis chặn việc gọi HUTECH: cho qua và ghi log
+                self.redis_errors += 1
+                logger.error(f"Lỗi rate limiter Redis, bỏ qua giới hạn cho request này: {e}")
+                return
+
+            if int(allowed) == 1:
+                self.granted[priority.name] += 1
+                return
+
+            wait = float(wait)
+            if wait > wait_until - time.monotonic():
+                self.rejected[priority.name] += 1
+                logger.warning(f"Rate limiter từ chối request mức {priority.name} (cần chờ {wait:.2f}s).")
+                raise RateLimitError(priority)
+
+            # Jitter để các instance không cùng thử lại một lúc
+            await asyncio.sleep(wait + random.uniform(0, wait / 2))
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Thống kê của rate limiter."""
+        return {
+            "enabled": self.enabled,
+            "rate": self.config.HUTECH_RATE_LIMIT,
+            "burst": self.config.HUTECH_RATE_BURST,
+            "granted": dict(self.granted),
+            "rejected": dict(self.rejected),
+            "redis_errors": self.redis_errors
+        }
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Retry budget và theo dõi độ trễ phục vụ retry/hedged request đến API HUTECH
+"""
+
+import random
+import time
+from collections import deque
+from typing import Deque, Dict, Any, Optional
+
+class RetryBudget:
+    """
+    Giới hạn tổng số retry/hedge theo tỷ lệ với số request gốc, để retry
+    không khuếch đại tải lên HUTECH khi upstream đang gặp sự cố.
+    """
+
+    def __init__(self, ratio: float, min_per_second: float, max_tokens: float):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self._last_refill = time.monotonic()
+
+        # Thống kê phục vụ giám sát
+        self.total_withdrawn = 0
+        self.total_exhausted = 0
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.max_tokens, self.tokens + (now - self._last_refill) * self.min_per_second)
+        self._last_refill = now
+
+    def deposit(self) -> None:
+        """Ghi nhận một request gốc, nạp thêm `ratio` lượt retry."""
+        self._refill()
+        self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        """Lấy một lượt retry/hedge. Trả về False nếu budget đã cạn."""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.total_withdrawn += 1
+            return True
+        self.total_exhausted += 1
+        return False
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Trạng thái hiện tại của retry budget."""
+        self._refill()
+        return {
+            "tokens": round(self.tokens, 1),
+            "withdrawn": self.total_withdrawn,
+            "exhausted": self.total_exhausted
+        }
+
+class LatencyTracker:
+    """Lưu độ trễ của các request gần nhất để ước lượng p95."""
+
+    def __init__(self, window: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._samples: Deque[float] = deque(maxlen=window)
+
+    def record(self, latency: float) -> None:
+        self._samples.append(latency)
+
+    def percentile(self, q: float) -> Optional[float]:
+        """Phân vị q (0-1) của độ trễ, None nếu chưa đủ mẫu."""
+        if len(self._samples) < self.min_samples:
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float) -> float:
+    """Thời gian chờ trước lần retry thứ `attempt` (exponential backoff với full jitter)."""
+    return random.uniform(0, min(max_delay, base_delay * (2 ** (attempt - 1))))
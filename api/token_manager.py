@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Quản lý vòng đời token HUTECH: làm mới trước khi hết hạn và đăng nhập lại khi gặp 401
+"""
+
+import asyncio
+import base64
+import binascii
+import json
+import logging
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from config.config import Config
+from api.rate_limiter import Priority, current_priority
+from cache.fetch_engine import NOT_LOGGED_IN
+from utils import deadline
+
+logger = logging.getLogger(__name__)
+
+# Chỉ xóa khóa đăng nhập lại nếu vẫn là khóa do chính lần gọi này đặt
+# (khóa có thể đã hết hạn và được instance khác lấy)
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+def decode_jwt_exp(token: str) -> Optional[float]:
+    """Lấy thời điểm hết hạn (exp, epoch giây) từ payload của JWT, None nếu không đọc được."""
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get("exp")
+        return float(exp) if exp is not None else None
+    except (IndexError, ValueError, TypeError, AttributeError, binascii.Error):
+        return None
+
+class TokenManager:
+    """
+    Cấp token cho các lệnh gọi API HUTECH của handler.
+
+    - Token sắp hết hạn (theo exp của JWT) được làm mới trong nền, token đã hết hạn được làm mới trước khi dùng.
+    - Khi API trả về 401, đăng nhập lại một lần bằng thông tin đã lưu và gọi lại API.
+    - Các lần làm mới đồng thời cho cùng người dùng dùng chung một lần đăng nhập
+      (single-flight trong tiến trình, khóa Redis giữa các instance).
+    """
+
+    def __init__(self, db_manager, cache_manager, login_handler):
+        self.db_manager = db_manager
+        self.cache_manager = cache_manager
+        self.login_handler = login_handler
+        self.config = Config()
+        self._tasks: Set[asyncio.Task] = set()
+        # Người dùng đang được làm mới token trong nền
+        self._refreshing: Set[int] = set()
+        # Script Lua được đăng ký một lần cho mỗi Redis client
+        self._release_script = None
+        self._release_script_client = None
+        self.refreshed = 0
+        self.refresh_failed = 0
+        self.unauthorized_retries = 0
+
+    async def get_token(self, telegram_user_id: int, old_token: bool = True,
+                        session: Optional[Dict[str, Any]] = None) -> Optional[str]:
+        """
+        Lấy token hợp lệ của người dùng.
+
+        Args:
+            telegram_user_id: ID của người dùng trên Telegram.
+            old_token: Ưu tiên token của old_login_info (các API elearning cũ).
+            session: Phiên đăng nhập handler đã đọc trong update này (tránh đọc lại).
+        """
+        if session is None:
+            token = await self._session_token(telegram_user_id, old_token)
+        else:
+            token = self.session_token(session, old_token)
+        if not token:
+            return None
+
+        exp = decode_jwt_exp(token)
+        if exp is None:
+            return token
+        left = exp - time.time()
+        if left <= 0:
+            # Token đã hết hạn: làm mới ngay, tránh gửi request chắc chắn bị 401
+            if await self.refresh(telegram_user_id, token):
+                return await self._session_token(telegram_user_id, old_token)
+            return token
+        if left <= self.config.TOKEN_REFRESH_AHEAD:
+            self._refresh_in_background(telegram_user_id, token)
+        return token
+
+    async def call(self, telegram_user_id: int, api_call: Callable[..., Awaitable[Any]], *args,
+                   old_token: bool = True, session: Optional[Dict[str, Any]] = None) -> Any:
+        """
+        Gọi api_call(token, *args) với token của người dùng, đăng nhập lại và gọi lại một lần nếu bị 401.
+
+        Args:
+            session: Phiên đăng nhập handler đã đọc trong update này (tránh đọc lại).
+
+        Returns:
+            Kết quả của api_call, hoặc NOT_LOGGED_IN nếu người dùng chưa đăng nhập.
+        """
+        token = await self.get_token(telegram_user_id, old_token, session)
+        if not token:
+            return NOT_LOGGED_IN
+
+        result = await api_call(token, *args)
+        if not self._is_unauthorized(result):
+            return result
+
+        self.unauthorized_retries += 1
+        logger.info(f"Token của người dùng {telegram_user_id} bị từ chối (401), đăng nhập lại.")
+        if not await self.refresh(telegram_user_id, token):
+            return result
+        new_token = await self._session_token(telegram_user_id, old_token)
+        if not new_token or new_token == token:
+            return result
+        return await api_call(new_token, *args)
+
+    @staticmethod
+    def _is_unauthorized(result: Any) -> bool:
+        return isinstance(result, dict) and result.get("error") and result.get("status_code") == 401
+
+    @staticmethod
+    def session_token(session: Optional[Dict[str, Any]], old_token: bool = True) -> Optional[str]:
+        """Token trong phiên đăng nhập (ưu tiên token của old_login_info nếu old_token)."""
+        if not session:
+            return None
+        if old_token and session["old_token"]:
+            return session["old_token"]
+        return session["token"]
+
+    async def _session_token(self, telegram_user_id: int, old_token: bool) -> Optional[str]:
+        return self.session_token(await self.db_manager.get_session(telegram_user_id), old_token)
+
+    async def refresh(self, telegram_user_id: int, stale_token: str) -> bool:
+        """
+        Đăng nhập lại để thay token stale_token. Trả về True nếu đã có token mới.
+        Các lần gọi đồng thời cho cùng người dùng dùng chung một lần đăng nhập.
+        """
+        return await self.cache_manager.single_flight.do(
+            f"relogin:{telegram_user_id}", lambda: self._refresh(telegram_user_id, stale_token)
+        )
+
+    async def _refresh(self, telegram_user_id: int, stale_token: str) -> bool:
+        lock_key = self.cache_manager.user_key("relogin_lock", telegram_user_id)
+        # Giá trị ngẫu nhiên của khóa, None nếu lần gọi này không giữ khóa.
+        # Không có Redis thì vẫn đăng nhập lại (chỉ mất phần gộp giữa các instance)
+        lock_token = None
+        if self.cache_manager.is_redis_available():
+            try:
+                r = self.cache_manager.get_redis_client()
+                token = uuid.uuid4().hex
+                locked = await self.cache_manager.redis_execute(
+                    r.set, lock_key, token, nx=True, ex=self.config.TOKEN_RELOGIN_LOCK_TTL
+                )
+                if not locked:
+                    return await self._wait_for_other_instance(telegram_user_id, stale_token)
+                lock_token = token
+            except Exception as e:
+                logger.warning(f"Không thể lấy khóa đăng nhập lại cho người dùng {telegram_user_id}: {e}")
+
+        try:
+            if await self.login_handler.refresh_session(telegram_user_id):
+                self.refreshed += 1
+                logger.info(f"Đã làm mới token cho người dùng {telegram_user_id}.")
+                return True
+            self.refresh_failed += 1
+            return False
+        finally:
+            if lock_token:
+                # Đăng nhập lại có thể đã dùng hết deadline của update: giải phóng khóa trong nền
+                task = asyncio.create_task(self._release_lock(lock_key, lock_token))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+
+    async def _release_lock(self, lock_key: str, lock_token: str):
+        deadline.set_deadline(None)
+        try:
+            r = self.cache_manager.get_redis_client()
+            if self._release_script is None or self._release_script_client is not r:
+                self._release_script = r.register_script(RELEASE_LOCK_SCRIPT)
+                self._release_script_client = r
+            await self.cache_manager.redis_execute(self._release_script, keys=[lock_key], args=[lock_token])
+        except Exception as e:
+            # Khóa tự hết hạn sau TOKEN_RELOGIN_LOCK_TTL
+            logger.warning(f"Không thể giải phóng khóa đăng nhập lại {lock_key}: {e}")
+
+    async def _wait_for_other_instance(self, telegram_user_id: int, stale_token: str) -> bool:
+        """Instance khác đang đăng nhập lại cho người dùng: chờ token mới xuất hiện trong phiên."""
+        wait_until = time.monotonic() + self.config.TOKEN_RELOGIN_LOCK_TTL
+        left = deadline.remaining()
+        if left is not None:
+            wait_until = min(wait_until, time.monotonic() + left)
+        while time.monotonic() + 0.5 < wait_until:
+            await asyncio.sleep(0.5)
+            session = await self.db_manager.get_session(telegram_user_id)
+            if session and stale_token not in (session["token"], session["old_token"]):
+                return True
+        return False
+
+    def _refresh_in_background(self, telegram_user_id: int, stale_token: str):
+        if telegram_user_id in self._refreshing:
+            return
+        self._refreshing.add(telegram_user_id)
+        task = asyncio.create_task(self._background_refresh(telegram_user_id, stale_token))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _background_refresh(self, telegram_user_id: int, stale_token: str):
+        # Người dùng không chờ việc làm mới: không gắn deadline của update và nhường token cho lệnh tương tác
+        deadline.set_deadline(None)
+        current_priority.set(Priority.BACKGROUND)
+        try:
+            await self.refresh(telegram_user_id, stale_token)
+        except Exception as e:
+            logger.warning(f"Không thể làm mới trước token cho người dùng {telegram_user_id}: {e}")
+        finally:
+            self._refreshing.discard(telegram_user_id)
+
+    async def close(self):
+        """Hủy các lần làm mới token đang chạy nền."""
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "refreshed": self.refreshed,
+            "refresh_failed": self.refresh_failed,
+            "unauthorized_retries": self.unauthorized_retries,
+        }
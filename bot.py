@@ -10,15 +10,19 @@ import logging
 import os
 import sys
 import asyncio
+from functools import partial
 from pathlib import Path
 
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler, CallbackQueryHandler
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, ConversationHandler, CallbackQueryHandler, TypeHandler
 
 from config.config import Config
 from database.db_manager import DatabaseManager
 from cache.cache_manager import CacheManager
+from cache.refresh_scheduler import RefreshAheadScheduler
+from api.hutech_client import HutechClient
+from api.token_manager import TokenManager
 from handlers.login_handler import LoginHandler
 from handlers.logout_handler import LogoutHandler
 from handlers.tkb_handler import TkbHandler
@@ -27,6 +31,7 @@ from handlers.diem_handler import DiemHandler
 from handlers.hoc_phan_handler import HocPhanHandler
 from handlers.diem_danh_handler import DiemDanhHandler
 from utils.utils import generate_uuid
+from utils import deadline
 
 # Cấu hình logging
 logging.basicConfig(
@@ -41,16 +46,33 @@ USERNAME, PASSWORD = range(2)
 class HutechBot:
     def __init__(self):
         self.config = Config()
-        self.db_manager = DatabaseManager()
         self.cache_manager = CacheManager()
-        self.login_handler = LoginHandler(self.db_manager, self.cache_manager)
-        self.logout_handler = LogoutHandler(self.db_manager, self.cache_manager)
-        self.tkb_handler = TkbHandler(self.db_manager, self.cache_manager)
-        self.lich_thi_handler = LichThiHandler(self.db_manager, self.cache_manager)
-        self.diem_handler = DiemHandler(self.db_manager, self.cache_manager)
-        self.hoc_phan_handler = HocPhanHandler(self.db_manager, self.cache_manager)
-        self.diem_danh_handler = DiemDanhHandler(self.db_manager, self.cache_manager)
+        self.db_manager = DatabaseManager(self.cache_manager)
+        self.hutech_client = HutechClient(self.cache_manager)
+        self.login_handler = LoginHandler(self.db_manager, self.cache_manager, self.hutech_client)
+        self.logout_handler = LogoutHandler(self.db_manager, self.cache_manager, self.hutech_client)
+        # Làm mới token sắp hết hạn và đăng nhập lại khi HUTECH trả về 401
+        self.token_manager = TokenManager(self.db_manager, self.cache_manager, self.login_handler)
+        self.tkb_handler = TkbHandler(self.db_manager, self.cache_manager, self.hutech_client, self.token_manager)
+        self.lich_thi_handler = LichThiHandler(self.db_manager, self.cache_manager, self.hutech_client, self.token_manager)
+        self.diem_handler = DiemHandler(self.db_manager, self.cache_manager, self.hutech_client, self.token_manager)
+        self.hoc_phan_handler = HocPhanHandler(self.db_manager, self.cache_manager, self.hutech_client, self.token_manager)
+        self.diem_danh_handler = DiemDanhHandler(self.db_manager, self.cache_manager, self.hutech_client, self.token_manager)
         
+        # Làm mới trước các cache sắp hết hạn của người dùng hoạt động gần đây
+        self.refresh_scheduler = RefreshAheadScheduler(self.cache_manager)
+        for namespace in ("tkb", "lichthi", "diem", "nam_hoc_hoc_ky"):
+            self.refresh_scheduler.register(namespace, partial(self.cache_manager.fetch_engine.refresh, namespace))
+        
+    async def start_update_deadline(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Gắn deadline cho update, được dùng bởi cache, database và API HUTECH khi xử lý update này"""
+        deadline.set_deadline(self.config.UPDATE_DEADLINE)
+    
+    async def track_user_activity(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Ghi nhận người dùng đang hoạt động để cache của họ được làm mới trước khi hết hạn"""
+        if update.effective_user:
+            await self.refresh_scheduler.touch(update.effective_user.id)
+    
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         """Xử lý lệnh /start"""
         user = update.effective_user
@@ -85,6 +107,77 @@ Các lệnh có sẵn:
         """
         await update.message.reply_text(help_text, reply_to_message_id=update.message.message_id)
     
+    async def status_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        """Xử lý lệnh /trangthai (chỉ dành cho quản trị viên)"""
+        if update.effective_user.id not in self.config.ADMIN_TELEGRAM_IDS:
+            return
+        
+        hutech_stats = self.hutech_client.get_stats()
+        limiter = hutech_stats["limiter"]
+        
+        message = "📊 Trạng thái hệ thống\n\n"
+        message += "HUTECH API (giới hạn đồng thời):\n"
+        message += f"- Giới hạn: {limiter['limit']} | Đang chạy: {limiter['in_flight']} | Đang chờ: {limiter['queued']} | Từ chối: {limiter['rejected']}\n"
+        
+        rate_limiter = hutech_stats["rate_limiter"]
+        message += "\nHUTECH API (rate limit dùng chung):\n"
+        if rate_limiter["enabled"]:
+            message += f"- {rate_limiter['rate']:g} req/s, burst {rate_limiter['burst']} | Lỗi Redis: {rate_limiter['redis_errors']}\n"
+            for name, granted in rate_limiter["granted"].items():
+                message += f"- {name}: cho phép {granted}, từ chối {rate_limiter['rejected'][name]}\n"
+        else:
+            message += "- Đang tắt.\n"
+        
+        retry_budget = hutech_stats["retry_budget"]
+        message += "\nRetry/hedge:\n"
+        message += f"- Budget còn: {retry_budget['tokens']} | Đã dùng: {retry_budget['withdrawn']} | Hết budget: {retry_budget['exhausted']} | Hedged: {hutech_stats['hedged_requests']}\n"
+        
+        cache_stats = self.cache_manager.get_stats()
+        l1 = cache_stats["l1"]
+        message += "\nCache:\n"
+        if l1["enabled"]:
+            message += f"- L1: hit {l1['hits']}, miss {l1['misses']} (tỉ lệ {l1['hit_ratio']:.1%}) | {l1['entries']} entry, {l1['bytes'] // 1024} KB | Loại bỏ: {l1['evictions']}\n"
+        else:
+            message += "- L1: đang tắt.\n"
+        message += f"- Redis: hit {cache_stats['redis']['hits']}, miss {cache_stats['redis']['misses']} (tỉ lệ {cache_stats['redis']['hit_ratio']:.1%}) | Single-flight dùng chung: {cache_stats['single_flight_shared']}\n"
+        redis_breaker = cache_stats["redis"]["breaker"]
+        message += (
+            f"- Kết nối Redis: {'hoạt động' if cache_stats['redis']['available'] else 'gián đoạn'} "
+            f"| Breaker: {redis_breaker['state']} | Lỗi: {redis_breaker['failures']} | Dùng cache cục bộ: {cache_stats['redis']['fallbacks']}\n"
+        )
+        
+        ttl_stats = ", ".join(f"{name} {policy['ttl']}s" for name, policy in cache_stats["ttl_policy"].items())
+        message += f"- TTL: {ttl_stats}\n"
+        fetch_stats = ", ".join(
+            f"{name} {stats['hits']}/{stats['misses']}/{stats['fetch_errors']}" for name, stats in cache_stats["fetch"].items()
+        )
+        message += f"- Hit/miss/lỗi theo namespace: {fetch_stats}\n"
+        if cache_stats["invalidation"]:
+            invalidation = cache_stats["invalidation"]
+            message += f"- Invalidation L1: gửi {invalidation['published']}, nhận {invalidation['received']}, đồng bộ lại {invalidation['resyncs']}\n"
+        refresh_stats = self.refresh_scheduler.get_stats()
+        message += f"- Làm mới trước: đang chờ {refresh_stats['scheduled']}, thành công {refresh_stats['refreshed']}, lỗi {refresh_stats['failed']}\n"
+        token_stats = self.token_manager.get_stats()
+        message += f"- Token: làm mới {token_stats['refreshed']}, lỗi {token_stats['refresh_failed']}, gọi lại sau 401: {token_stats['unauthorized_retries']}\n"
+        
+        db_stats = self.db_manager.get_stats()
+        message += "\nPostgreSQL pool:\n"
+        message += (
+            f"- Kết nối: {db_stats['size']} (rảnh {db_stats['idle']}, min {db_stats['min_size']}, max {db_stats['max_size']}) "
+            f"| Chờ kết nối: TB {db_stats['wait_avg_ms']:.1f} ms, tối đa {db_stats['wait_max_ms']:.1f} ms | Hết thời gian chờ: {db_stats['acquire_timeouts']}\n"
+        )
+        
+        message += "\nCircuit breaker:\n"
+        if not hutech_stats["breakers"]:
+            message += "- Chưa có request nào.\n"
+        for endpoint, breaker in hutech_stats["breakers"].items():
+            message += (
+                f"- {endpoint}: {breaker['state']} (lỗi liên tiếp: {breaker['consecutive_failures']}, "
+                f"thành công: {breaker['successes']}, lỗi: {breaker['failures']}, từ chối: {breaker['rejected']})\n"
+            )
+        
+        await update.message.reply_text(message, reply_to_message_id=update.message.message_id)
+    
     async def login_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         """Bắt đầu quá trình đăng nhập"""
         user_id = update.effective_user.id
@@ -1164,6 +1257,10 @@ Các lệnh có sẵn:
     
     def setup_handlers(self, application: Application) -> None:
         """Thiết lập các handler cho bot"""
+        # Gắn deadline cho mỗi update trước khi các handler khác xử lý
+        application.add_handler(TypeHandler(Update, self.start_update_deadline), group=-10)
+        application.add_handler(TypeHandler(Update, self.track_user_activity), group=-9)
+        
         # Handler cho lệnh cơ bản
         application.add_handler(CommandHandler("start", self.start_command))
         # Conversation handler cho đăng nhập được định nghĩa riêng
@@ -1175,6 +1272,7 @@ Các lệnh có sẵn:
         application.add_handler(CommandHandler("huy", self.cancel_command))
         application.add_handler(CommandHandler("trogiup", self.help_command))
         application.add_handler(CommandHandler("dangxuat", self.logout_command))
+        application.add_handler(CommandHandler("trangthai", self.status_command))
         
         # Conversation handler cho đăng nhập
         conv_handler = ConversationHandler(
@@ -1199,29 +1297,13 @@ Các lệnh có sẵn:
         # Đặt ở group=-1 để đảm bảo nó chỉ được xử lý sau khi các handler khác không khớp
         application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.diemdanh_code_received), group=-1)
     
-    async def auto_refresh_cache_task(self):
-        """Tác vụ nền tự động xóa cache của người dùng đang đăng nhập."""
-        while True:
-            await asyncio.sleep(600) # Chờ 10 phút
-            
-            logger.info("Bắt đầu tác vụ tự động làm mới cache...")
-            logged_in_users = await self.db_manager.get_all_logged_in_users()
-            
-            if logged_in_users:
-                logger.info(f"Tìm thấy {len(logged_in_users)} người dùng đang đăng nhập. Tiến hành xóa cache.")
-                for user_id in logged_in_users:
-                    await self.cache_manager.clear_user_cache(user_id)
-                logger.info("Hoàn tất tác vụ tự động làm mới cache.")
-            else:
-                logger.info("Không có người dùng nào đang đăng nhập. Bỏ qua lần làm mới này.")
-
     async def run(self) -> None:
         """Khởi chạy bot và quản lý vòng đời của các kết nối."""
-        # Kết nối đến cơ sở dữ liệu và cache
+        # Kết nối đến cơ sở dữ liệu, cache và API HUTECH
         await self.db_manager.connect()
         await self.cache_manager.connect()
+        await self.hutech_client.connect()
 
-        auto_refresh_task = None
         try:
             # Tạo ứng dụng
             application = Application.builder().token(self.config.TELEGRAM_BOT_TOKEN).build()
@@ -1239,8 +1321,8 @@ Các lệnh có sẵn:
                 await application.start()
                 await application.updater.start_polling()
                 
-                # Bắt đầu tác vụ nền
-                auto_refresh_task = asyncio.create_task(self.auto_refresh_cache_task())
+                # Bắt đầu tác vụ nền làm mới cache trước khi hết hạn
+                self.refresh_scheduler.start()
                 
                 # Giữ bot chạy cho đến khi nhận được tín hiệu dừng (ví dụ: Ctrl+C)
                 while True:
@@ -1249,9 +1331,9 @@ Các lệnh có sẵn:
         except (KeyboardInterrupt, SystemExit):
             logger.info("Đang dừng bot...")
         finally:
-            # Hủy tác vụ nền
-            if auto_refresh_task:
-                auto_refresh_task.cancel()
+            # Dừng tác vụ nền
+            await self.refresh_scheduler.stop()
+            await self.token_manager.close()
 
             # Đảm bảo đóng các kết nối khi bot dừng
             if application.updater and application.updater.is_running:
@@ -1261,6 +1343,7 @@ Các lệnh có sẵn:
             
             await self.db_manager.close()
             await self.cache_manager.close()
+            await self.hutech_client.close()
             logger.info("Bot đã dừng và đóng các kết nối.")
 
 async def main() -> None:
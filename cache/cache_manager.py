@@ -5,91 +5,606 @@
 Quản lý cache sử dụng Redis
 """
 
+import asyncio
 import json
+import time
 import logging
-from typing import Optional, Any, Dict
+from typing import Optional, Any, Awaitable, Callable, Dict, List, Set, Tuple
 from datetime import datetime
 
 import redis.asyncio as redis
+from redis.asyncio.cluster import RedisCluster
+from redis.asyncio.sentinel import Sentinel
 
 from config.config import Config
+from cache.single_flight import SingleFlight
+from cache.local_cache import LocalCache
+from cache.codec import CacheCodec
+from cache.ttl_policy import TtlPolicy
+from cache.schema import SchemaRegistry
+from cache.fetch_engine import FetchEngine
+from cache.invalidation import CacheInvalidator
+from api.circuit_breaker import CircuitBreaker, CircuitOpenError
+from api.rate_limiter import Priority, current_priority
+from utils import deadline
 
 logger = logging.getLogger(__name__)
 
 class CacheManager:
     def __init__(self):
         self.config = Config()
-        self.redis_pool = None
+        # Một Redis client dùng chung cho cả tiến trình (tự quản lý connection pool)
+        self.redis_client = None
+        # Gộp các lần cache miss đồng thời cho cùng key thành một lần gọi upstream
+        self.single_flight = SingleFlight()
+        # Cache-aside dùng chung cho các handler (mỗi namespace đăng ký một nguồn dữ liệu)
+        self.fetch_engine = FetchEngine(self)
+        # Codec cho payload cache, có thể chọn theo namespace và nén payload lớn
+        self.codec = CacheCodec(
+            default_codec=self.config.CACHE_CODEC,
+            namespace_codecs=self.config.CACHE_CODEC_NAMESPACES,
+            compression=self.config.CACHE_COMPRESSION,
+            compress_threshold=self.config.CACHE_COMPRESS_THRESHOLD,
+            compress_level=self.config.CACHE_COMPRESS_LEVEL
+        )
+        # TTL theo namespace, tự điều chỉnh theo tần suất dữ liệu thay đổi
+        self.ttl_policy = TtlPolicy(
+            policies=self.config.CACHE_TTL_POLICIES,
+            overrides=self.config.CACHE_TTL_OVERRIDES
+        )
+        # Phiên bản định dạng dữ liệu theo namespace, envelope cũ được nâng cấp khi đọc
+        self.schemas = SchemaRegistry()
+        # Cache L1 trong bộ nhớ tiến trình, tránh round trip Redis và json.loads cho key vừa đọc
+        self.local_cache = None
+        if self.config.CACHE_L1_ENABLED:
+            self.local_cache = LocalCache(
+                max_bytes=self.config.CACHE_L1_MAX_BYTES,
+                default_max_entries=self.config.CACHE_L1_MAX_ENTRIES,
+                namespace_limits=self.config.CACHE_L1_NAMESPACE_LIMITS
+            )
+        # Khi Redis gặp sự cố, breaker mở và cache tạm dùng bộ nhớ tiến trình cho đến khi Redis hoạt động lại
+        self.redis_breaker = CircuitBreaker(
+            "redis",
+            failure_threshold=self.config.REDIS_BREAKER_FAILURE_THRESHOLD,
+            recovery_timeout=self.config.REDIS_BREAKER_RECOVERY_TIMEOUT
+        )
+        self.fallback_cache = self.local_cache or LocalCache(
+            max_bytes=self.config.REDIS_FALLBACK_MAX_BYTES,
+            default_max_entries=self.config.CACHE_L1_MAX_ENTRIES
+        )
+        self.redis_fallbacks = 0
+        self._health_task: Optional[asyncio.Task] = None
+        # Các lệnh xóa bị bỏ qua trên Redis khi breaker mở, được thực hiện lại trước khi đóng breaker
+        # (nếu không, dữ liệu đã xóa như phiên đăng nhập sẽ xuất hiện lại sau khi Redis phục hồi)
+        self._pending_deletes: Set[str] = set()
+        self._pending_user_clears: Set[int] = set()
+        # Giữ L1 của các instance khác nhất quán khi instance này ghi/xóa cache
+        self.invalidator = None
+        if self.local_cache:
+            self.invalidator = CacheInvalidator(self, self.config.CACHE_INVALIDATION_CHANNEL)
+        self.l1_hits = 0
+        self.l1_misses = 0
+        self.redis_hits = 0
+        self.redis_misses = 0
+        self.stale_hits = 0
+        self.legacy_hits = 0
+        # Các key đang được làm mới nền sau khi trả dữ liệu cũ (stale-while-revalidate)
+        self._revalidating: Set[str] = set()
+        self._revalidate_tasks: Set[asyncio.Task] = set()
 
     async def connect(self):
-        """Khởi tạo Redis connection pool."""
-        if not self.redis_pool:
+        """Khởi tạo Redis client theo REDIS_MODE (standalone, sentinel hoặc cluster)."""
+        if not self.redis_client:
             try:
-                self.redis_pool = redis.ConnectionPool.from_url(
-                    self.config.REDIS_URL,
-                    decode_responses=True  # Tự động decode responses thành string
-                )
-                logger.info("Đã tạo Redis connection pool thành công.")
+                mode = self.config.REDIS_MODE
+                # decode_responses=False: giữ bytes để lưu payload nhị phân (msgpack, nén zlib)
+                if mode == "cluster":
+                    self.redis_client = RedisCluster.from_url(
+                        self.config.REDIS_URL,
+                        max_connections=self.config.REDIS_POOL_SIZE,
+                        decode_responses=False
+                    )
+                elif mode == "sentinel":
+                    sentinel = Sentinel(
+                        self.config.REDIS_SENTINELS,
+                        sentinel_kwargs={"password": self.config.REDIS_SENTINEL_PASSWORD} if self.config.REDIS_SENTINEL_PASSWORD else None,
+                        password=self.config.REDIS_PASSWORD or None,
+                        db=self.config.REDIS_DB,
+                        max_connections=self.config.REDIS_POOL_SIZE,
+                        decode_responses=False
+                    )
+                    # Client tự tìm lại master qua Sentinel khi có failover
+                    self.redis_client = sentinel.master_for(self.config.REDIS_SENTINEL_MASTER)
+                else:
+                    self.redis_client = redis.Redis.from_url(
+                        self.config.REDIS_URL,
+                        max_connections=self.config.REDIS_POOL_SIZE,
+                        decode_responses=False
+                    )
+                logger.info(f"Đã tạo Redis client ({mode}) thành công.")
+                if self.invalidator:
+                    self.invalidator.start()
+                self._health_task = asyncio.create_task(self._health_check_loop())
             except Exception as e:
-                logger.error(f"Không thể tạo Redis connection pool: {e}")
+                logger.error(f"Không thể tạo Redis client: {e}")
                 raise
 
     async def close(self):
-        """Đóng Redis connection pool."""
-        if self.redis_pool:
-            await self.redis_pool.disconnect()
-            logger.info("Đã đóng Redis connection pool.")
+        """Đóng Redis client và connection pool của nó."""
+        for task in list(self._revalidate_tasks):
+            task.cancel()
+        await self.fetch_engine.close()
+        if self.invalidator:
+            await self.invalidator.stop()
+        if self._health_task:
+            self._health_task.cancel()
+            await asyncio.gather(self._health_task, return_exceptions=True)
+            self._health_task = None
+        if self.redis_client:
+            await self.redis_client.aclose()
+            self.redis_client = None
+            logger.info("Đã đóng Redis client.")
 
     def get_redis_client(self) -> redis.Redis:
-        """Lấy một client từ connection pool."""
-        if not self.redis_pool:
-            raise ConnectionError("Redis connection pool chưa được khởi tạo. Hãy gọi connect() trước.")
-        return redis.Redis(connection_pool=self.redis_pool)
+        """Lấy Redis client dùng chung."""
+        if not self.redis_client:
+            raise ConnectionError("Redis client chưa được khởi tạo. Hãy gọi connect() trước.")
+        return self.redis_client
 
-    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+    @staticmethod
+    def user_key(namespace: str, telegram_user_id: int, *parts: str) -> str:
+        """
+        Tạo cache key của người dùng dạng "<namespace>:{<telegram_user_id>}[:...]".
+
+        Phần {<telegram_user_id>} là hash tag: trên Redis Cluster mọi key của một người dùng
+        (kể cả index user_keys) nằm cùng một slot, nên có thể xóa/ghi chung trong một lệnh.
+        """
+        return ":".join((namespace, f"{{{telegram_user_id}}}") + parts)
+
+    @staticmethod
+    def user_id_from_key(key: str) -> Optional[int]:
+        """Lấy telegram_user_id từ cache key tạo bởi user_key, hoặc None nếu không phải key của người dùng."""
+        parts = key.split(":", 2)
+        if len(parts) >= 2:
+            user_id = parts[1].strip("{}")
+            if user_id.isdigit():
+                return int(user_id)
+        return None
+
+    @classmethod
+    def legacy_key(cls, key: str) -> Optional[str]:
+        """Key định dạng cũ (không có hash tag, ví dụ "tkb:123") tương ứng với key của người dùng, hoặc None."""
+        user_id = cls.user_id_from_key(key)
+        if user_id is None:
+            return None
+        return key.replace(f"{{{user_id}}}", str(user_id), 1)
+
+    def _user_index_keys(self, telegram_user_id: int) -> List[str]:
+        """Các index chứa cache key của người dùng (kèm index định dạng cũ trong thời gian chuyển đổi)."""
+        index_keys = [self.user_key("user_keys", telegram_user_id)]
+        if self.config.CACHE_LEGACY_KEY_FALLBACK:
+            index_keys.append(f"user_keys:{telegram_user_id}")
+        return index_keys
+
+    def _queue_key_delete(self, pipe, key: str):
+        """Thêm vào pipeline lệnh xóa key, gỡ key khỏi index người dùng và xóa key định dạng cũ tương ứng."""
+        pipe.unlink(key)
+        index_key = self._user_index_key(key)
+        if index_key:
+            pipe.srem(index_key, key)
+        legacy_key = self.legacy_key(key) if self.config.CACHE_LEGACY_KEY_FALLBACK else None
+        if legacy_key:
+            # Không để key cũ được chuyển lại sang key mới ở lần đọc sau
+            pipe.unlink(legacy_key)
+
+    def _queue_user_deletes(self, pipe, index_keys: List[str], members_list: List[Set[bytes]]):
+        """Thêm vào pipeline lệnh xóa các key trong index của người dùng (kết quả SMEMBERS của _user_index_keys)."""
+        index_key, *legacy_index_keys = index_keys
+        members, *legacy_members_list = members_list
+        if members:
+            # UNLINK giải phóng bộ nhớ ở thread nền của Redis; chỉ SREM các key đã xóa
+            # để không làm mất key được ghi đồng thời vào index
+            pipe.unlink(*members)
+            pipe.srem(index_key, *members)
+        for legacy_index_key, legacy_members in zip(legacy_index_keys, legacy_members_list):
+            # Key cũ không có hash tag, có thể nằm ở các slot khác nhau trên Cluster: mỗi key một lệnh
+            for member in legacy_members:
+                pipe.unlink(member)
+            pipe.unlink(legacy_index_key)
+
+    def _user_index_key(self, key: str) -> Optional[str]:
+        """Key của tập index chứa các cache key của người dùng."""
+        user_id = self.user_id_from_key(key)
+        if user_id is None:
+            return None
+        return self.user_key("user_keys", user_id)
+
+    def _timeout(self) -> float:
+        """Timeout cho một lệnh Redis, giới hạn bởi deadline của update đang xử lý."""
+        return deadline.budget(self.config.REDIS_TIMEOUT)
+
+    def is_redis_available(self) -> bool:
+        """False khi circuit breaker của Redis đang mở (không nên gọi Redis)."""
+        return self.redis_breaker.state == CircuitBreaker.CLOSED
+
+    async def redis_execute(self, func: Callable[..., Awaitable[Any]], *args, **kwargs) -> Any:
+        """
+        Chạy một lệnh (hoặc pipeline) Redis với timeout và ghi nhận kết quả vào circuit breaker.
+        Các module khác dùng chung Redis client (rate limiter, refresh-ahead, token manager) cũng gọi qua đây
+        để Redis bị treo làm mở breaker thay vì chặn từng request.
+
+        Args:
+            func: Hàm bất đồng bộ của Redis client/pipeline, ví dụ pipe.execute.
+        """
+        timeout = self._timeout()
+        try:
+            result = await asyncio.wait_for(func(*args, **kwargs), timeout=timeout)
+        except asyncio.TimeoutError:
+            # Hết giờ vì deadline của update (ngắn hơn REDIS_TIMEOUT) không phải lỗi của Redis
+            if timeout >= self.config.REDIS_TIMEOUT:
+                self.redis_breaker.record_failure()
+            raise
+        except (redis.ConnectionError, redis.TimeoutError, OSError):
+            self.redis_breaker.record_failure()
+            raise
+        self.redis_breaker.record_success()
+        return result
+
+    async def _health_check_loop(self):
+        """Khi breaker mở, định kỳ PING Redis trong nền và đóng breaker khi Redis phản hồi."""
+        while True:
+            await asyncio.sleep(max(self.redis_breaker.retry_after(), 1.0))
+            if self.is_redis_available():
+                continue
+            try:
+                self.redis_breaker.before_request()
+            except CircuitOpenError:
+                continue
+            try:
+                await asyncio.wait_for(self.redis_client.ping(), timeout=self.config.REDIS_TIMEOUT)
+                await self._replay_pending_deletes()
+            except Exception as e:
+                self.redis_breaker.record_failure()
+                logger.warning(f"Redis vẫn chưa hoạt động: {e}")
+                continue
+            self.redis_breaker.record_success()
+            # Dữ liệu ghi cục bộ trong lúc Redis gián đoạn có thể khác với Redis và các instance khác
+            self.fallback_cache.clear()
+            logger.info("Redis đã hoạt động trở lại, ngừng dùng cache cục bộ thay thế.")
+
+    async def _replay_pending_deletes(self):
+        """Xóa trên Redis các key và cache người dùng đã bị bỏ qua trong lúc Redis gián đoạn."""
+        keys = list(self._pending_deletes)
+        user_ids = list(self._pending_user_clears)
+        if not keys and not user_ids:
+            return
+        r = self.get_redis_client()
+        index_keys = {user_id: self._user_index_keys(user_id) for user_id in user_ids}
+        members = []
+        if user_ids:
+            pipe = r.pipeline(transaction=False)
+            for user_id in user_ids:
+                for index_key in index_keys[user_id]:
+                    pipe.smembers(index_key)
+            members = await asyncio.wait_for(pipe.execute(), timeout=self.config.REDIS_TIMEOUT)
+
+        pipe = r.pipeline(transaction=False)
+        for key in keys:
+            self._queue_key_delete(pipe, key)
+        position = 0
+        for user_id in user_ids:
+            count = len(index_keys[user_id])
+            self._queue_user_deletes(pipe, index_keys[user_id], members[position:position + count])
+            position += count
+        if self.invalidator:
+            if keys:
+                pipe.publish(self.invalidator.channel, self.invalidator.message(keys=keys))
+            for user_id in user_ids:
+                pipe.publish(self.invalidator.channel, self.invalidator.message(telegram_user_id=user_id))
+        await asyncio.wait_for(pipe.execute(), timeout=self.config.REDIS_TIMEOUT)
+
+        self._pending_deletes.difference_update(keys)
+        self._pending_user_clears.difference_update(user_ids)
+        logger.info(f"Đã xóa lại trên Redis {len(keys)} key và cache của {len(user_ids)} người dùng bị bỏ qua khi Redis gián đoạn.")
+
+    async def get(self, key: str, revalidate: Optional[Callable[[], Awaitable[Any]]] = None) -> Optional[Dict[str, Any]]:
         """
         Lấy dữ liệu từ cache.
 
         Args:
             key: Khóa của cache.
+            revalidate: Hàm làm mới cache. Nếu có, dữ liệu đã quá soft TTL vẫn được trả về
+                ngay và hàm này được chạy nền một lần; nếu không, dữ liệu cũ được coi là miss.
 
         Returns:
             Một dictionary chứa 'data' và 'timestamp', hoặc None nếu không tìm thấy.
         """
+        envelopes = await self._get_envelopes([key])
+        return self._check_fresh(key, envelopes[key], revalidate)
+
+    async def get_many(self, keys: List[str],
+                       revalidators: Optional[Dict[str, Callable[[], Awaitable[Any]]]] = None) -> Dict[str, Optional[Dict[str, Any]]]:
+        """
+        Lấy nhiều key trong một round trip Redis (MGET).
+
+        Args:
+            keys: Danh sách khóa cache.
+            revalidators: Hàm làm mới cho từng key (xem tham số revalidate của get).
+
+        Returns:
+            Dictionary key -> envelope ('data', 'timestamp') hoặc None nếu không tìm thấy.
+        """
+        revalidators = revalidators or {}
+        envelopes = await self._get_envelopes(keys)
+        return {key: self._check_fresh(key, envelopes[key], revalidators.get(key)) for key in keys}
+
+    def _check_fresh(self, key: str, cached: Optional[Dict[str, Any]],
+                     revalidate: Optional[Callable[[], Awaitable[Any]]]) -> Optional[Dict[str, Any]]:
+        """Áp dụng soft TTL: trả dữ liệu cũ kèm làm mới nền nếu có revalidate, ngược lại coi là miss."""
+        if cached is None:
+            return None
+
+        fresh_until = cached.get("fresh_until")
+        if fresh_until is None or time.time() < fresh_until:
+            return cached
+
+        if revalidate is None:
+            logger.info(f"Cache STALE for key: {key}")
+            return None
+
+        self.stale_hits += 1
+        logger.info(f"Cache STALE for key: {key}, trả dữ liệu cũ và làm mới nền.")
+        self._start_revalidation(key, revalidate)
+        return cached
+
+    def _start_revalidation(self, key: str, revalidate: Callable[[], Awaitable[Any]]):
+        if key in self._revalidating:
+            return
+        self._revalidating.add(key)
+        task = asyncio.create_task(self._revalidate(key, revalidate))
+        self._revalidate_tasks.add(task)
+        task.add_done_callback(self._revalidate_tasks.discard)
+
+    async def _revalidate(self, key: str, revalidate: Callable[[], Awaitable[Any]]):
+        # Người dùng đã nhận dữ liệu cũ, việc làm mới không bị giới hạn bởi deadline của update
+        deadline.set_deadline(None)
+        current_priority.set(Priority.BACKGROUND)
+        try:
+            await revalidate()
+        except Exception as e:
+            logger.error(f"Lỗi làm mới nền cache cho key '{key}': {e}")
+        finally:
+            self._revalidating.discard(key)
+
+    async def _get_envelopes(self, keys: List[str]) -> Dict[str, Optional[Dict[str, Any]]]:
+        """Đọc envelope (data, timestamp, ...) của các key từ L1 hoặc Redis, không xét soft TTL."""
+        results: Dict[str, Optional[Dict[str, Any]]] = {key: None for key in keys}
+        remote_keys = []
+        for key in results:
+            if self.local_cache:
+                local_data = self.local_cache.get(key)
+                if local_data is not None:
+                    self.l1_hits += 1
+                    logger.debug(f"Cache L1 HIT for key: {key}")
+                    results[key] = local_data
+                    continue
+                self.l1_misses += 1
+            remote_keys.append(key)
+
+        if not remote_keys:
+            return results
+
+        if not self.is_redis_available():
+            self.redis_fallbacks += 1
+            if self.fallback_cache is not self.local_cache:
+                for key in remote_keys:
+                    results[key] = self.fallback_cache.get(key)
+            return results
+
         try:
             r = self.get_redis_client()
-            cached_data = await r.get(key)
-            if cached_data:
-                logger.info(f"Cache HIT for key: {key}")
+            pipe = r.pipeline(transaction=False)
+            if isinstance(r, RedisCluster):
+                # MGET trên Cluster chỉ dùng được khi các key cùng slot, pipeline sẽ tự chia theo node
+                for key in remote_keys:
+                    pipe.get(key)
+            else:
+                pipe.mget(remote_keys)
+            for key in remote_keys:
+                pipe.pttl(key)
+            results_raw = await self.redis_execute(pipe.execute)
+            if isinstance(r, RedisCluster):
+                values, ttls = results_raw[:len(remote_keys)], results_raw[len(remote_keys):]
+            else:
+                values, ttls = results_raw[0], results_raw[1:]
+        except Exception as e:
+            logger.error(f"Lỗi lấy cache cho key {remote_keys}: {e}")
+            return results
+
+        if self.config.CACHE_LEGACY_KEY_FALLBACK:
+            missing = [key for key, cached_data in zip(remote_keys, values) if not cached_data and self.legacy_key(key)]
+            if missing:
+                legacy = await self._migrate_legacy_keys(missing)
+                for i, key in enumerate(remote_keys):
+                    if key in legacy:
+                        values[i], ttls[i] = legacy[key]
+
+        for key, cached_data, ttl_ms in zip(remote_keys, values, ttls):
+            if not cached_data:
+                self.redis_misses += 1
+                logger.info(f"Cache MISS for key: {key}")
+                continue
+            try:
                 # Dữ liệu trả về là một dict chứa data và timestamp
-                return json.loads(cached_data)
-            logger.info(f"Cache MISS for key: {key}")
-            return None
+                result, size = self.codec.decode(cached_data)
+            except Exception as e:
+                logger.error(f"Lỗi giải mã cache cho key '{key}': {e}")
+                continue
+            result = self.schemas.upgrade(key, result)
+            if result is None:
+                self.redis_misses += 1
+                continue
+            self.redis_hits += 1
+            logger.info(f"Cache HIT for key: {key}")
+            if self.local_cache and ttl_ms > 0:
+                # Không giữ ở L1 lâu hơn thời gian còn lại trên Redis
+                self.local_cache.set(key, result, min(self.config.CACHE_L1_TTL, ttl_ms / 1000), size)
+            results[key] = result
+        return results
+
+    async def _migrate_legacy_keys(self, keys: List[str]) -> Dict[str, Tuple[bytes, int]]:
+        """
+        Đọc key định dạng cũ của các key bị miss và chuyển sang key mới (giữ TTL còn lại, ghi vào index
+        của người dùng để clear_user_cache xóa được), rồi xóa key cũ.
+
+        Returns:
+            Dictionary key mới -> (payload, TTL còn lại tính bằng ms) của các key tìm thấy ở định dạng cũ.
+        """
+        migrated: Dict[str, Tuple[bytes, int]] = {}
+        try:
+            r = self.get_redis_client()
+            pipe = r.pipeline(transaction=False)
+            for key in keys:
+                legacy_key = self.legacy_key(key)
+                pipe.get(legacy_key)
+                pipe.pttl(legacy_key)
+            results = await self.redis_execute(pipe.execute)
+
+            pipe = r.pipeline(transaction=False)
+            for i, key in enumerate(keys):
+                payload, ttl_ms = results[2 * i], results[2 * i + 1]
+                if not payload or ttl_ms <= 0:
+                    continue
+                migrated[key] = (payload, ttl_ms)
+                # nx: không ghi đè giá trị mới được ghi đồng thời
+                pipe.set(key, payload, px=ttl_ms, nx=True)
+                index_key = self._user_index_key(key)
+                pipe.sadd(index_key, key)
+                pipe.expire(index_key, max(ttl_ms // 1000 + 1, self.config.CACHE_USER_INDEX_TTL))
+                pipe.unlink(self.legacy_key(key))
+            if migrated:
+                await self.redis_execute(pipe.execute)
+                self.legacy_hits += len(migrated)
+                logger.info(f"Đã chuyển {len(migrated)} cache key từ định dạng cũ: {', '.join(migrated)}")
         except Exception as e:
-            logger.error(f"Lỗi lấy cache cho key '{key}': {e}")
-            return None
+            logger.error(f"Lỗi đọc cache key định dạng cũ cho {keys}: {e}")
+        return migrated
 
-    async def set(self, key: str, value: Any, ttl: int = 3600):
+    async def set(self, key: str, value: Any, ttl: Optional[int] = None, stale_ttl: int = 0) -> Dict[str, Any]:
         """
         Lưu dữ liệu vào cache cùng với timestamp.
 
         Args:
             key: Khóa của cache.
             value: Dữ liệu cần lưu.
-            ttl: Thời gian sống của cache (time-to-live) tính bằng giây. Mặc định là 1 giờ.
+            ttl: Thời gian sống của cache (time-to-live) tính bằng giây. Mặc định lấy từ
+                ttl_policy theo namespace (tự điều chỉnh), hoặc 1 giờ nếu namespace chưa cấu hình.
+            stale_ttl: Số giây dữ liệu được giữ thêm sau ttl để trả về khi đang làm mới nền
+                (soft TTL = ttl, hard TTL = ttl + stale_ttl). Mặc định 0 (không dùng dữ liệu cũ).
+
+        Returns:
+            Envelope ('data', 'timestamp') đã lưu.
         """
-        try:
-            r = self.get_redis_client()
+        envelopes = await self.set_many({key: (value, ttl)}, stale_ttl=stale_ttl)
+        return envelopes[key]
+
+    async def set_many(self, items: Dict[str, Tuple[Any, Optional[int]]], stale_ttl: int = 0) -> Dict[str, Dict[str, Any]]:
+        """
+        Lưu nhiều key trong một pipeline Redis.
+
+        Args:
+            items: Dictionary key -> (dữ liệu, ttl tính bằng giây hoặc None để dùng ttl_policy).
+            stale_ttl: Như tham số stale_ttl của set, áp dụng cho tất cả các key.
+
+        Returns:
+            Dictionary key -> envelope đã lưu (trả về cả khi ghi Redis thất bại).
+        """
+        timestamp = datetime.utcnow().isoformat()
+        envelopes = {}
+        ttls = {}
+        for key, (value, ttl) in items.items():
+            if ttl is None:
+                ttl = self.ttl_policy.observe(key, value)
+            ttls[key] = ttl
             # Tạo một đối tượng để lưu trữ cả dữ liệu và timestamp
-            data_to_cache = {
-                "timestamp": datetime.utcnow().isoformat(),
+            envelopes[key] = {
+                "timestamp": timestamp,
                 "data": value
             }
-            serialized_value = json.dumps(data_to_cache, ensure_ascii=False)
-            await r.set(key, serialized_value, ex=ttl)
-            logger.info(f"Đã lưu cache cho key: {key} với TTL: {ttl} giây.")
+            if stale_ttl > 0:
+                envelopes[key]["fresh_until"] = time.time() + ttl
+            self.schemas.stamp(key, envelopes[key])
+
+        if not self.is_redis_available():
+            self.redis_fallbacks += 1
+            self._set_fallback(envelopes, ttls, stale_ttl)
+            return envelopes
+
+        try:
+            r = self.get_redis_client()
+            pipe = r.pipeline(transaction=False)
+            local_entries = []
+            for key, data_to_cache in envelopes.items():
+                ttl = ttls[key]
+                serialized_value, size = self.codec.encode(key, data_to_cache)
+                pipe.set(key, serialized_value, ex=ttl + stale_ttl)
+                index_key = self._user_index_key(key)
+                if index_key:
+                    # Ghi key vào index của người dùng để clear_user_cache không phải SCAN toàn bộ keyspace
+                    pipe.sadd(index_key, key)
+                    pipe.expire(index_key, max(ttl + stale_ttl, self.config.CACHE_USER_INDEX_TTL))
+                local_entries.append((key, data_to_cache, ttl + stale_ttl, size))
+            if self.invalidator:
+                pipe.publish(self.invalidator.channel, self.invalidator.message(keys=list(envelopes)))
+
+            await self.redis_execute(pipe.execute)
+            if self.local_cache:
+                for key, data_to_cache, ttl, size in local_entries:
+                    self.local_cache.set(key, data_to_cache, min(self.config.CACHE_L1_TTL, ttl), size)
+            for key, ttl in ttls.items():
+                logger.info(f"Đã lưu cache cho key: {key} với TTL: {ttl} giây.")
         except Exception as e:
-            logger.error(f"Lỗi lưu cache cho key '{key}': {e}")
+            logger.error(f"Lỗi lưu cache cho key {list(items)}: {e}")
+            if not self.is_redis_available():
+                self._set_fallback(envelopes, ttls, stale_ttl)
+        return envelopes
+
+    def _set_fallback(self, envelopes: Dict[str, Dict[str, Any]], ttls: Dict[str, int], stale_ttl: int):
+        """Lưu envelope vào cache cục bộ khi không ghi được Redis."""
+        for key, data_to_cache in envelopes.items():
+            size = len(json.dumps(data_to_cache, ensure_ascii=False, default=str))
+            ttl = min(self.config.REDIS_FALLBACK_TTL, ttls[key] + stale_ttl)
+            self.fallback_cache.set(key, data_to_cache, ttl, size)
+
+    @staticmethod
+    def negative_key(key: str) -> str:
+        """Key negative cache của key dữ liệu (cùng hash tag nên cùng slot với key dữ liệu)."""
+        return f"neg_{key}"
+
+    async def get_negative(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Lấy kết quả lỗi đã được cache cho key (negative cache).
+
+        Args:
+            key: Khóa của cache dữ liệu tương ứng (ví dụ "tkb:<telegram_user_id>").
+
+        Returns:
+            Dữ liệu lỗi đã lưu, hoặc None nếu không có.
+        """
+        cached = await self.get(self.negative_key(key))
+        return cached.get("data") if cached else None
+
+    async def set_negative(self, key: str, value: Dict[str, Any], ttl: Optional[int] = None):
+        """
+        Cache ngắn hạn một kết quả lỗi cho key. Key được ghi vào index của người dùng
+        nên sẽ bị xóa bởi clear_user_cache (ví dụ khi đăng nhập thành công).
+
+        Args:
+            key: Khóa của cache dữ liệu tương ứng.
+            value: Dữ liệu lỗi cần lưu.
+            ttl: Thời gian sống (giây), mặc định CACHE_NEGATIVE_TTL.
+        """
+        await self.set(self.negative_key(key), value, ttl=ttl or self.config.CACHE_NEGATIVE_TTL)
 
     async def delete(self, key: str):
         """
@@ -98,12 +613,40 @@ class CacheManager:
         Args:
             key: Khóa của cache cần xóa.
         """
+        await self.delete_many([key])
+
+    async def delete_many(self, keys: List[str]):
+        """
+        Xóa nhiều key trong một pipeline Redis (UNLINK, không chặn Redis).
+
+        Args:
+            keys: Danh sách khóa cache cần xóa.
+        """
+        if not keys:
+            return
         try:
+            if not self.is_redis_available():
+                self.redis_fallbacks += 1
+                self._pending_deletes.update(keys)
+                logger.warning(f"Redis không khả dụng, chỉ xóa cache cục bộ cho key: {', '.join(keys)}")
+                return
             r = self.get_redis_client()
-            await r.delete(key)
-            logger.info(f"Đã xóa cache cho key: {key}")
+            pipe = r.pipeline(transaction=False)
+            for key in keys:
+                # Mỗi key một lệnh UNLINK vì các key có thể thuộc các slot khác nhau trên Cluster
+                self._queue_key_delete(pipe, key)
+            if self.invalidator:
+                pipe.publish(self.invalidator.channel, self.invalidator.message(keys=keys))
+            await self.redis_execute(pipe.execute)
+            logger.info(f"Đã xóa cache cho key: {', '.join(keys)}")
         except Exception as e:
-            logger.error(f"Lỗi xóa cache cho key '{key}': {e}")
+            logger.error(f"Lỗi xóa cache cho key {keys}: {e}")
+            if not self.is_redis_available():
+                self._pending_deletes.update(keys)
+        finally:
+            # Xóa L1 sau Redis để không bị một lần đọc Redis đồng thời ghi lại giá trị cũ
+            for key in keys:
+                self.fallback_cache.delete(key)
 
     async def clear_user_cache(self, telegram_user_id: int):
         """
@@ -111,14 +654,62 @@ class CacheManager:
         Hữu ích khi người dùng đăng xuất.
         """
         try:
+            if not self.is_redis_available():
+                self.redis_fallbacks += 1
+                self._pending_user_clears.add(telegram_user_id)
+                logger.warning(f"Redis không khả dụng, chỉ xóa cache cục bộ cho người dùng {telegram_user_id}.")
+                return
             r = self.get_redis_client()
-            # Xóa các cache theo pattern
-            keys_to_delete = []
-            async for key in r.scan_iter(f"*:{telegram_user_id}"):
-                keys_to_delete.append(key)
+            index_keys = self._user_index_keys(telegram_user_id)
+            # Lấy các key từ index của người dùng thay vì SCAN toàn bộ keyspace
+            pipe = r.pipeline(transaction=False)
+            for index_key in index_keys:
+                pipe.smembers(index_key)
+            members_list = await self.redis_execute(pipe.execute)
             
-            if keys_to_delete:
-                await r.delete(*keys_to_delete)
-                logger.info(f"Đã xóa {len(keys_to_delete)} cache keys cho người dùng {telegram_user_id}.")
+            pipe = r.pipeline(transaction=False)
+            self._queue_user_deletes(pipe, index_keys, members_list)
+            if self.invalidator:
+                pipe.publish(self.invalidator.channel, self.invalidator.message(telegram_user_id=telegram_user_id))
+            if len(pipe):
+                await self.redis_execute(pipe.execute)
+            deleted = sum(len(members) for members in members_list)
+            if deleted:
+                logger.info(f"Đã xóa {deleted} cache keys cho người dùng {telegram_user_id}.")
         except Exception as e:
-            logger.error(f"Lỗi xóa cache cho người dùng {telegram_user_id}: {e}")
\ No newline at end of file
+            logger.error(f"Lỗi xóa cache cho người dùng {telegram_user_id}: {e}")
+            if not self.is_redis_available():
+                self._pending_user_clears.add(telegram_user_id)
+        finally:
+            self.fallback_cache.delete_user(telegram_user_id)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Thống kê tỉ lệ hit của từng tầng cache (L1 và Redis)."""
+        l1_total = self.l1_hits + self.l1_misses
+        redis_total = self.redis_hits + self.redis_misses
+        return {
+            "l1": {
+                "enabled": self.local_cache is not None,
+                "hits": self.l1_hits,
+                "misses": self.l1_misses,
+                "hit_ratio": round(self.l1_hits / l1_total, 3) if l1_total else 0.0,
+                **(self.local_cache.get_stats() if self.local_cache else {}),
+            },
+            "redis": {
+                "hits": self.redis_hits,
+                "misses": self.redis_misses,
+                "hit_ratio": round(self.redis_hits / redis_total, 3) if redis_total else 0.0,
+                "available": self.is_redis_available(),
+                "fallbacks": self.redis_fallbacks,
+                "pending_deletes": len(self._pending_deletes) + len(self._pending_user_clears),
+                "breaker": self.redis_breaker.get_stats(),
+            },
+            "stale_hits": self.stale_hits,
+            "legacy_hits": self.legacy_hits,
+            "codec": self.codec.get_stats(),
+            "ttl_policy": self.ttl_policy.get_stats(),
+            "single_flight_shared": self.single_flight.shared_count,
+            "fetch": self.fetch_engine.get_stats(),
+            "schema": self.schemas.get_stats(),
+            "invalidation": self.invalidator.get_stats() if self.invalidator else None,
+        }
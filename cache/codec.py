@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Mã hóa/giải mã envelope cache (JSON, orjson, msgpack) kèm nén zlib cho payload lớn
+"""
+
+import json
+import logging
+import zlib
+from typing import Any, Dict, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+# Payload mới bắt đầu bằng MAGIC, sau đó là 1 byte mã codec và 1 byte mã nén.
+# Payload cũ là chuỗi JSON thuần (bắt đầu bằng '{') và vẫn đọc được.
+MAGIC = b"\x00"
+CODEC_IDS = {"json": 1, "orjson": 2, "msgpack": 3}
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+
+class CacheCodec:
+    def __init__(self, default_codec: str = "json", namespace_codecs: Optional[Dict[str, str]] = None,
+                 compression: str = "zlib", compress_threshold: int = 1024, compress_level: int = 6):
+        self.default_codec = self._available(default_codec)
+        self.namespace_codecs = {
+            namespace: self._available(codec) for namespace, codec in (namespace_codecs or {}).items()
+        }
+        self.compression = compression
+        self.compress_threshold = compress_threshold
+        self.compress_level = compress_level
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+
+    @staticmethod
+    def _available(codec: str) -> str:
+        """Trả về codec nếu dùng được, ngược lại quay về json (thiếu thư viện hoặc tên không hợp lệ)."""
+        if codec not in CODEC_IDS:
+            logger.warning(f"Codec cache không hợp lệ '{codec}', dùng json.")
+            return "json"
+        if (codec == "orjson" and orjson is None) or (codec == "msgpack" and msgpack is None):
+            logger.warning(f"Chưa cài thư viện cho codec cache '{codec}', dùng json.")
+            return "json"
+        return codec
+
+    def _codec_for(self, key: str) -> str:
+        return self.namespace_codecs.get(key.split(":", 1)[0], self.default_codec)
+
+    def encode(self, key: str, envelope: Dict[str, Any]) -> Tuple[bytes, int]:
+        """
+        Mã hóa envelope của một cache key.
+
+        Returns:
+            (payload lưu vào Redis, kích thước trước khi nén)
+        """
+        codec = self._codec_for(key)
+        if codec == "orjson":
+            body = orjson.dumps(envelope, option=orjson.OPT_NON_STR_KEYS)
+        elif codec == "msgpack":
+            body = msgpack.packb(envelope, use_bin_type=True)
+        else:
+            body = json.dumps(envelope, ensure_ascii=False).encode("utf-8")
+
+        raw_size = len(body)
+        compression = COMPRESSION_NONE
+        if self.compression == "zlib" and raw_size >= self.compress_threshold:
+            body = zlib.compress(body, self.compress_level)
+            compression = COMPRESSION_ZLIB
+
+        self.raw_bytes += raw_size
+        self.stored_bytes += len(body) + 3
+        return MAGIC + bytes((CODEC_IDS[codec], compression)) + body, raw_size
+
+    def decode(self, payload: bytes) -> Tuple[Dict[str, Any], int]:
+        """
+        Giải mã payload đọc từ Redis (hỗ trợ cả định dạng JSON cũ).
+
+        Returns:
+            (envelope, kích thước sau khi giải nén)
+        """
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        if not payload.startswith(MAGIC):
+            return json.loads(payload), len(payload)
+
+        codec_id, compression = payload[1], payload[2]
+        body = payload[3:]
+        if compression == COMPRESSION_ZLIB:
+            body = zlib.decompress(body)
+
+        if codec_id == CODEC_IDS["orjson"]:
+            envelope = orjson.loads(body) if orjson else json.loads(body)
+        elif codec_id == CODEC_IDS["msgpack"]:
+            if msgpack is None:
+                raise ValueError("Payload cache dùng msgpack nhưng chưa cài thư viện msgpack.")
+            envelope = msgpack.unpackb(body, raw=False)
+        else:
+            envelope = json.loads(body)
+        return envelope, len(body)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "default_codec": self.default_codec,
+            "compression": self.compression,
+            "raw_bytes": self.raw_bytes,
+            "stored_bytes": self.stored_bytes,
+        }
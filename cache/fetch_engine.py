@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Cache-aside dùng chung cho các handler: kiểm tra cache -> gọi HUTECH -> lưu cache
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set
+
+from api.rate_limiter import Priority, current_priority
+from utils import deadline
+
+logger = logging.getLogger(__name__)
+
+# Kết quả fetcher trả về khi người dùng chưa đăng nhập (không lưu vào negative cache của nguồn dữ liệu)
+NOT_LOGGED_IN = {
+    "error": True,
+    "not_logged_in": True,
+    "message": "Bạn chưa đăng nhập. Vui lòng sử dụng /login để đăng nhập."
+}
+
+# Kết quả khi deadline của update hết trong lúc chờ lần gọi HUTECH dùng chung
+DEADLINE_EXCEEDED = {
+    "error": True,
+    "timeout": True,
+    "message": "Hệ thống HUTECH phản hồi quá chậm, vui lòng thử lại sau."
+}
+
+def non_empty_list(value: Any) -> bool:
+    """validate cho các API trả về danh sách (TKB, điểm, lịch thi, ...)."""
+    return isinstance(value, list) and bool(value)
+
+class DataSource:
+    def __init__(self, fetcher: Callable[..., Awaitable[Any]], validate: Callable[[Any], bool],
+                 ttl: Optional[int], stale_ttl: int):
+        self.fetcher = fetcher
+        self.validate = validate
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+
+class FetchEngine:
+    """
+    Mỗi namespace được đăng ký một nguồn dữ liệu (fetcher). get_or_fetch áp dụng cho mọi namespace:
+    L1/Redis cache, stale-while-revalidate, negative cache, single-flight và thống kê.
+    """
+
+    def __init__(self, cache_manager):
+        self.cache_manager = cache_manager
+        self._sources: Dict[str, DataSource] = {}
+        self.stats: Dict[str, Dict[str, int]] = {}
+        self._warmup_tasks: Set[asyncio.Task] = set()
+
+    def register(self, namespace: str, fetcher: Callable[..., Awaitable[Any]],
+                 validate: Optional[Callable[[Any], bool]] = None, ttl: Optional[int] = None, stale_ttl: int = 0,
+                 version: int = 1, migrations: Optional[Dict[int, Callable[[Any], Any]]] = None,
+                 servable_from: Optional[int] = None):
+        """
+        Đăng ký nguồn dữ liệu cho namespace.
+
+        Args:
+            namespace: Namespace của cache key (ví dụ "tkb").
+            fetcher: Hàm bất đồng bộ fetcher(telegram_user_id, *parts) trả về dữ liệu cần cache,
+                hoặc dict lỗi ({"error": True, ...}) / None nếu thất bại.
+            validate: Kiểm tra dữ liệu hợp lệ để lưu cache (mặc định: khác rỗng và không phải dict lỗi).
+            ttl: TTL cố định (giây), mặc định dùng ttl_policy của CacheManager.
+            stale_ttl: Thời gian giữ dữ liệu cũ để trả về trong khi làm mới nền.
+            version: Phiên bản định dạng dữ liệu fetcher trả về, tăng khi đổi định dạng.
+            migrations: Hàm nâng cấp dữ liệu đã cache từ phiên bản v lên v + 1 (xem SchemaRegistry).
+            servable_from: Phiên bản cũ thấp nhất vẫn hiển thị được trong lúc chờ làm mới.
+        """
+        self._sources[namespace] = DataSource(fetcher, validate or self._default_validate, ttl, stale_ttl)
+        self.cache_manager.schemas.register(namespace, version, migrations, servable_from)
+        self.stats[namespace] = {"hits": 0, "misses": 0, "negative_hits": 0, "fetch_errors": 0}
+
+    def stale_ttl(self, namespace: str) -> int:
+        """stale_ttl đã đăng ký cho namespace (0 nếu chưa đăng ký): TTL trên Redis = TTL tươi + stale_ttl."""
+        source = self._sources.get(namespace)
+        return source.stale_ttl if source else 0
+
+    @staticmethod
+    def _default_validate(value: Any) -> bool:
+        return bool(value) and not (isinstance(value, dict) and value.get("error"))
+
+    async def get_or_fetch(self, namespace: str, telegram_user_id: int, *parts: str,
+                           process: Optional[Callable[[Any], Dict[str, Any]]] = None) -> Dict[str, Any]:
+        """
+        Lấy dữ liệu của người dùng từ cache, hoặc gọi fetcher khi cache miss.
+
+        Args:
+            namespace: Namespace đã đăng ký.
+            telegram_user_id: ID của người dùng trên Telegram.
+            parts: Các thành phần bổ sung của cache key (ví dụ mã lớp học phần).
+            process: Hàm xử lý dữ liệu thô thành dict hiển thị; timestamp của cache được thêm vào kết quả.
+
+        Returns:
+            {"success": True, "data": ..., "from_cache": bool} hoặc {"success": False, "error": dict lỗi hoặc None}
+        """
+        source = self._sources[namespace]
+        stats = self.stats[namespace]
+        key = self.cache_manager.user_key(namespace, telegram_user_id, *parts)
+
+        negative_key = self.cache_manager.negative_key(key)
+
+        revalidators = {}
+        if source.stale_ttl:
+            revalidators[key] = lambda: self.refresh(namespace, telegram_user_id, *parts)
+        # Đọc dữ liệu và negative cache của key trong một round trip, không cần đọc lại negative cache khi miss
+        cached = await self.cache_manager.get_many([key, negative_key], revalidators)
+        envelope = cached[key]
+        from_cache = envelope is not None
+
+        if envelope is None:
+            stats["misses"] += 1
+            negative = cached[negative_key]
+            if negative:
+                stats["negative_hits"] += 1
+                return {"success": False, "error": negative.get("data")}
+            # Các lần cache miss đồng thời dùng chung một lần gọi HUTECH
+            try:
+                result = await self.cache_manager.single_flight.do(
+                    key, lambda: self._fetch_and_store(namespace, key, telegram_user_id, parts, check_negative=False)
+                )
+            except deadline.DeadlineExceeded:
+                # Lần gọi dùng chung (có thể do làm nóng/làm mới nền khởi tạo) chưa xong trong deadline của update;
+                # nó vẫn chạy tiếp và lưu cache cho lần sau
+                stats["fetch_errors"] += 1
+                return {"success": False, "error": dict(DEADLINE_EXCEEDED)}
+            if not result.get("success"):
+                return result
+            envelope = result["envelope"]
+        else:
+            stats["hits"] += 1
+
+        data = envelope.get("data")
+        if process:
+            data = process(data)
+            if isinstance(data, dict):
+                data["timestamp"] = envelope.get("timestamp")
+        return {"success": True, "data": data, "from_cache": from_cache}
+
+    async def refresh(self, namespace: str, telegram_user_id: int, *parts: str) -> bool:
+        """Gọi lại fetcher và cập nhật cache (dùng cho làm mới nền). Trả về True nếu thành công."""
+        key = self.cache_manager.user_key(namespace, telegram_user_id, *parts)
+        result = await self.cache_manager.single_flight.do(
+            key, lambda: self._fetch_and_store(namespace, key, telegram_user_id, parts)
+        )
+        return result.get("success", False)
+
+    def warm_up(self, telegram_user_id: int, namespaces: Iterable[str]):
+        """
+        Lấy trước dữ liệu của các namespace cho người dùng trong nền (không chờ kết quả).
+
+        Args:
+            telegram_user_id: ID của người dùng trên Telegram.
+            namespaces: Các namespace đã đăng ký cần làm nóng (namespace chưa đăng ký bị bỏ qua).
+        """
+        namespaces = [namespace for namespace in namespaces if namespace in self._sources]
+        if not namespaces:
+            return
+        task = asyncio.create_task(self._warm_up(telegram_user_id, namespaces))
+        self._warmup_tasks.add(task)
+        task.add_done_callback(self._warmup_tasks.discard)
+
+    async def _warm_up(self, telegram_user_id: int, namespaces: List[str]):
+        # Người dùng không chờ kết quả: không gắn deadline của update và nhường token cho lệnh tương tác
+        deadline.set_deadline(None)
+        current_priority.set(Priority.BACKGROUND)
+        results = await asyncio.gather(
+            *(self.refresh(namespace, telegram_user_id) for namespace in namespaces), return_exceptions=True
+        )
+        warmed = [namespace for namespace, ok in zip(namespaces, results) if ok is True]
+        for namespace, result in zip(namespaces, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Không thể làm nóng cache {namespace} cho người dùng {telegram_user_id}: {result}")
+        logger.info(f"Đã làm nóng cache cho người dùng {telegram_user_id}: {', '.join(warmed) or 'không có'}.")
+
+    async def close(self):
+        """Hủy các tác vụ làm nóng cache đang chạy."""
+        tasks = list(self._warmup_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _fetch_and_store(self, namespace: str, key: str, telegram_user_id: int, parts,
+                               check_negative: bool = True) -> Dict[str, Any]:
+        source = self._sources[namespace]
+        stats = self.stats[namespace]
+
+        # Lỗi gần đây của HUTECH (5xx, 429) cho key này được cache ngắn hạn để không gọi lại liên tục
+        # (get_or_fetch đã đọc negative cache cùng với dữ liệu)
+        if check_negative:
+            negative = await self.cache_manager.get_negative(key)
+            if negative:
+                stats["negative_hits"] += 1
+                return {"success": False, "error": negative}
+
+        value = await source.fetcher(telegram_user_id, *parts)
+        if source.validate(value):
+            # set trả về envelope đã lưu, không cần đọc lại cache để lấy timestamp
+            envelope = await self.cache_manager.set(key, value, ttl=source.ttl, stale_ttl=source.stale_ttl)
+            return {"success": True, "envelope": envelope}
+
+        stats["fetch_errors"] += 1
+        if self._is_upstream_failure(value):
+            await self.cache_manager.set_negative(key, value)
+        return {"success": False, "error": value}
+
+    @staticmethod
+    def _is_upstream_failure(value: Any) -> bool:
+        """
+        Chỉ negative cache lỗi phía HUTECH (5xx, 429), tức lỗi gọi lại ngay cũng sẽ lặp lại.
+        Lỗi 4xx khác đến từ chính request hoặc token của người dùng; timeout theo deadline và các lần
+        bot tự từ chối (circuit breaker, rate limit, giới hạn đồng thời) không có status_code và chỉ là tạm thời.
+        Cache các lỗi đó sẽ khóa người dùng này khỏi dữ liệu cho đến khi negative cache hết hạn,
+        kể cả khi họ thử lại ngay sau khi lỗi đã hết.
+        """
+        if not isinstance(value, dict) or not value.get("error"):
+            return False
+        status_code = value.get("status_code")
+        return isinstance(status_code, int) and (status_code >= 500 or status_code == 429)
+
+    def get_stats(self) -> Dict[str, Dict[str, int]]:
+        return {namespace: dict(stats) for namespace, stats in self.stats.items()}
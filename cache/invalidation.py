@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Đồng bộ cache L1 giữa các instance qua kênh pub/sub của Redis
+"""
+
+import asyncio
+import json
+import logging
+import uuid
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+class CacheInvalidator:
+    """
+    Mỗi lần ghi/xóa cache, CacheManager gửi kèm (trong cùng pipeline) một thông báo lên kênh
+    invalidation. Các instance khác nhận thông báo và xóa key tương ứng khỏi L1 của mình,
+    nên đường đọc không cần thêm round trip Redis để kiểm tra dữ liệu còn đúng hay không.
+    """
+
+    def __init__(self, cache_manager, channel: str):
+        self.cache_manager = cache_manager
+        self.channel = channel
+        # Bỏ qua thông báo do chính instance này gửi
+        self.instance_id = uuid.uuid4().hex
+        self._task: Optional[asyncio.Task] = None
+        self.published = 0
+        self.received = 0
+        self.resyncs = 0
+
+    def message(self, keys: Optional[List[str]] = None, telegram_user_id: Optional[int] = None) -> bytes:
+        """
+        Tạo thông báo invalidation để gửi bằng lệnh PUBLISH.
+
+        Args:
+            keys: Các key vừa được ghi hoặc xóa.
+            telegram_user_id: Xóa toàn bộ key của người dùng (clear_user_cache).
+        """
+        self.published += 1
+        payload: Dict[str, Any] = {"origin": self.instance_id}
+        if keys:
+            payload["keys"] = keys
+        if telegram_user_id is not None:
+            payload["user"] = telegram_user_id
+        return json.dumps(payload).encode("utf-8")
+
+    def start(self):
+        """Bắt đầu lắng nghe kênh invalidation."""
+        if not self._task:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Dừng lắng nghe."""
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        connected_before = False
+        while True:
+            pubsub = None
+            try:
+                if not self.cache_manager.is_redis_available():
+                    # Chờ health check của CacheManager xác nhận Redis hoạt động lại
+                    await asyncio.sleep(1)
+                    continue
+                pubsub = self.cache_manager.get_redis_client().pubsub()
+                await pubsub.subscribe(self.channel)
+                if connected_before:
+                    # Có thể đã lỡ thông báo trong lúc mất kết nối, L1 không còn đáng tin
+                    self.resyncs += 1
+                    self.cache_manager.local_cache.clear()
+                    logger.warning("Đã kết nối lại kênh invalidation cache, xóa toàn bộ L1.")
+                connected_before = True
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        self._apply(message["data"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Mất kết nối kênh invalidation cache: {e}")
+                await asyncio.sleep(1)
+            finally:
+                if pubsub is not None:
+                    try:
+                        await pubsub.aclose()
+                    except Exception:
+                        pass
+
+    def _apply(self, data: bytes):
+        try:
+            payload = json.loads(data)
+        except (TypeError, ValueError):
+            logger.warning(f"Thông báo invalidation không hợp lệ: {data!r}")
+            return
+        if payload.get("origin") == self.instance_id:
+            return
+        self.received += 1
+        local_cache = self.cache_manager.local_cache
+        for key in payload.get("keys", ()):
+            local_cache.delete(key)
+        if payload.get("user") is not None:
+            local_cache.delete_user(payload["user"])
+
+    def get_stats(self) -> Dict[str, int]:
+        return {
+            "published": self.published,
+            "received": self.received,
+            "resyncs": self.resyncs,
+        }
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Cache trong bộ nhớ tiến trình (L1) dạng LRU có TTL, đặt trước Redis
+"""
+
+import time
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class LocalCache:
+    """
+    LRU cache giới hạn theo tổng dung lượng và số entry của từng namespace.
+
+    Namespace là phần trước dấu ':' đầu tiên của key (ví dụ "tkb" trong "tkb:{123}").
+    Giá trị được trả về trực tiếp (không sao chép), caller chỉ nên đọc.
+    """
+
+    def __init__(self, max_bytes: int, default_max_entries: int, namespace_limits: Optional[Dict[str, int]] = None):
+        self.max_bytes = max_bytes
+        self.default_max_entries = default_max_entries
+        self.namespace_limits = namespace_limits or {}
+        # key -> (thời điểm hết hạn, giá trị, kích thước ước lượng)
+        self._entries: "OrderedDict[str, Tuple[float, Any, int]]" = OrderedDict()
+        self._namespace_counts: Dict[str, int] = {}
+        self._bytes = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _namespace(key: str) -> str:
+        return key.split(":", 1)[0]
+
+    def get(self, key: str) -> Optional[Any]:
+        """Lấy giá trị còn hạn, đồng thời đánh dấu key vừa được dùng."""
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key: str, value: Any, ttl: float, size: int):
+        """
+        Lưu giá trị vào L1.
+
+        Args:
+            key: Khóa của cache.
+            value: Giá trị đã giải mã.
+            ttl: Thời gian sống (giây).
+            size: Kích thước ước lượng (byte), thường là độ dài chuỗi JSON.
+        """
+        if ttl <= 0 or size > self.max_bytes:
+            self.delete(key)
+            return
+
+        namespace = self._namespace(key)
+        max_entries = self.namespace_limits.get(namespace, self.default_max_entries)
+        if max_entries <= 0:
+            return
+
+        self._remove(key)
+        self._entries[key] = (time.monotonic() + ttl, value, size)
+        self._namespace_counts[namespace] = self._namespace_counts.get(namespace, 0) + 1
+        self._bytes += size
+
+        # Loại entry cũ nhất của namespace khi vượt số lượng cho phép
+        if self._namespace_counts[namespace] > max_entries:
+            for old_key in self._entries:
+                if self._namespace(old_key) == namespace:
+                    self._remove(old_key)
+                    self.evictions += 1
+                    break
+
+        # Loại entry ít dùng nhất toàn cục khi vượt dung lượng
+        while self._bytes > self.max_bytes and self._entries:
+            old_key = next(iter(self._entries))
+            self._remove(old_key)
+            self.evictions += 1
+
+    def delete(self, key: str):
+        """Xóa một key khỏi L1."""
+        self._remove(key)
+
+    def delete_user(self, telegram_user_id: int) -> int:
+        """Xóa tất cả key của một người dùng (dạng "<namespace>:{<telegram_user_id>}[:...]")."""
+        user_tag = f"{{{telegram_user_id}}}"
+        keys = [key for key in self._entries if key.split(":", 2)[1:2] == [user_tag]]
+        for key in keys:
+            self._remove(key)
+        return len(keys)
+
+    def clear(self):
+        """Xóa toàn bộ L1."""
+        self._entries.clear()
+        self._namespace_counts.clear()
+        self._bytes = 0
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        namespace = self._namespace(key)
+        self._namespace_counts[namespace] -= 1
+        if not self._namespace_counts[namespace]:
+            del self._namespace_counts[namespace]
+        self._bytes -= entry[2]
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+            "namespaces": dict(self._namespace_counts),
+        }
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Làm mới cache trước khi hết hạn (refresh-ahead) cho những người dùng hoạt động gần đây
+"""
+
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Set
+
+from config.config import Config
+from api.rate_limiter import Priority, current_priority
+from utils import deadline
+
+logger = logging.getLogger(__name__)
+
+class RefreshAheadScheduler:
+    """
+    Định kỳ kiểm tra TTL còn lại của các cache key thuộc người dùng hoạt động gần đây
+    và làm mới những key sắp hết hạn vào một thời điểm ngẫu nhiên trước khi hết hạn.
+    """
+
+    def __init__(self, cache_manager, active_users_key: str = "active_users"):
+        self.cache_manager = cache_manager
+        self.config = Config()
+        self.active_users_key = active_users_key
+        # namespace -> hàm làm mới cache của người dùng trong namespace đó
+        self._refreshers: Dict[str, Callable[[int], Awaitable[bool]]] = {}
+        self._scheduled: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self._last_touch: Dict[int, float] = {}
+        self._semaphore = asyncio.Semaphore(self.config.REFRESH_AHEAD_CONCURRENCY)
+        self._loop_task: Optional[asyncio.Task] = None
+        self.refreshed = 0
+        self.failed = 0
+
+    def register(self, namespace: str, refresher: Callable[[int], Awaitable[bool]]):
+        """Đăng ký hàm làm mới (trả về True nếu thành công) cho key user_key(namespace, telegram_user_id)."""
+        self._refreshers[namespace] = refresher
+
+    async def touch(self, telegram_user_id: int):
+        """Ghi nhận người dùng vừa hoạt động (ghi lên Redis tối đa mỗi phút một lần cho mỗi người dùng)."""
+        now = time.time()
+        if now - self._last_touch.get(telegram_user_id, 0) < 60 or not self.cache_manager.is_redis_available():
+            return
+        self._last_touch[telegram_user_id] = now
+        try:
+            r = self.cache_manager.get_redis_client()
+            await self.cache_manager.redis_execute(r.zadd, self.active_users_key, {str(telegram_user_id): now})
+        except Exception as e:
+            logger.warning(f"Không thể ghi nhận hoạt động của người dùng {telegram_user_id}: {e}")
+
+    def start(self):
+        """Bắt đầu vòng lặp làm mới cache nền."""
+        if not self._loop_task:
+            self._loop_task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Dừng vòng lặp và hủy các lần làm mới đang chờ."""
+        tasks = list(self._tasks)
+        if self._loop_task:
+            tasks.append(self._loop_task)
+            self._loop_task = None
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self):
+        # Tác vụ nền không bị giới hạn bởi deadline của update và nhường token cho lệnh người dùng
+        deadline.set_deadline(None)
+        current_priority.set(Priority.BACKGROUND)
+        # Lệch pha giữa các instance để không quét cùng lúc
+        await asyncio.sleep(random.uniform(0, self.config.REFRESH_AHEAD_INTERVAL))
+        while True:
+            try:
+                # Không làm mới trước khi Redis gián đoạn (dữ liệu chỉ lưu được vào cache cục bộ)
+                if self.cache_manager.is_redis_available():
+                    await self._scan()
+            except Exception as e:
+                logger.error(f"Lỗi khi quét cache để làm mới trước: {e}")
+            await asyncio.sleep(self.config.REFRESH_AHEAD_INTERVAL)
+
+    async def _scan(self):
+        """Tìm các key sắp hết hạn của người dùng hoạt động gần đây và lên lịch làm mới."""
+        # Mọi lệnh Redis đi qua redis_execute (timeout + circuit breaker) để Redis bị treo không chặn vòng quét
+        r = self.cache_manager.get_redis_client()
+        now = time.time()
+        cutoff = now - self.config.REFRESH_AHEAD_ACTIVE_WINDOW
+        pipe = r.pipeline(transaction=False)
+        pipe.zremrangebyscore(self.active_users_key, "-inf", cutoff)
+        pipe.zrangebyscore(self.active_users_key, cutoff, "+inf")
+        _, active_users = await self.cache_manager.redis_execute(pipe.execute)
+        user_ids = [int(user_id) for user_id in active_users]
+        self._last_touch = {user_id: ts for user_id, ts in self._last_touch.items() if ts > cutoff}
+        if not user_ids or not self._refreshers:
+            return
+
+        targets = [(namespace, user_id) for user_id in user_ids for namespace in self._refreshers]
+        pipe = r.pipeline(transaction=False)
+        for namespace, user_id in targets:
+            pipe.pttl(self.cache_manager.user_key(namespace, user_id))
+        ttls = await self.cache_manager.redis_execute(pipe.execute)
+
+        scheduled = 0
+        for (namespace, user_id), ttl_ms in zip(targets, ttls):
+            key = self.cache_manager.user_key(namespace, user_id)
+            if ttl_ms <= 0 or key in self._scheduled:
+                continue
+            # TTL trên Redis gồm cả stale_ttl của namespace, thời gian còn "tươi" là phần TTL trước đó
+            ttl_ms = max(ttl_ms - self.cache_manager.fetch_engine.stale_ttl(namespace) * 1000, 1)
+            # Chỉ làm mới key còn tồn tại (người dùng đã từng xem) và sắp hết hạn
+            if ttl_ms > self.config.REFRESH_AHEAD_WINDOW * 1000:
+                continue
+            # Rải đều thời điểm làm mới trong nửa đầu thời gian còn lại để tránh dồn request
+            delay = random.uniform(0, min(self.config.REFRESH_AHEAD_INTERVAL, ttl_ms / 2000))
+            self._scheduled.add(key)
+            task = asyncio.create_task(self._refresh(key, namespace, user_id, delay))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+            scheduled += 1
+
+        if scheduled:
+            logger.info(f"Đã lên lịch làm mới trước {scheduled} cache key cho {len(user_ids)} người dùng hoạt động.")
+
+    async def _refresh(self, key: str, namespace: str, user_id: int, delay: float):
+        try:
+            await asyncio.sleep(delay)
+            async with self._semaphore:
+                # Khóa ngắn trên Redis để chỉ một instance làm mới mỗi key
+                r = self.cache_manager.get_redis_client()
+                locked = await self.cache_manager.redis_execute(
+                    r.set, f"refresh_lock:{key}", "1", nx=True, ex=self.config.REFRESH_AHEAD_INTERVAL
+                )
+                if not locked:
+                    return
+                if await self._refreshers[namespace](user_id):
+                    self.refreshed += 1
+                else:
+                    self.failed += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failed += 1
+            logger.warning(f"Không thể làm mới trước cache key {key}: {e}")
+        finally:
+            self._scheduled.discard(key)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "scheduled": len(self._scheduled),
+            "refreshed": self.refreshed,
+            "failed": self.failed,
+        }
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Phiên bản định dạng dữ liệu cache theo namespace, nâng cấp envelope cũ khi đọc
+"""
+
+import logging
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# Envelope không có trường "v" (ghi trước khi có versioning) được coi là phiên bản 1
+DEFAULT_VERSION = 1
+
+class NamespaceSchema:
+    def __init__(self, version: int, migrations: Dict[int, Callable[[Any], Any]], servable_from: Optional[int]):
+        self.version = version
+        self.migrations = migrations
+        self.servable_from = servable_from
+
+class SchemaRegistry:
+    """
+    Mỗi namespace có một phiên bản định dạng dữ liệu. Envelope ghi vào cache mang phiên bản hiện tại;
+    khi đọc được envelope phiên bản cũ hơn:
+      - nếu có đủ hàm migrate từ phiên bản đó: nâng cấp dữ liệu ngay khi đọc (giữ nguyên độ tươi),
+      - nếu phiên bản >= servable_from: vẫn trả về nhưng coi như đã cũ (stale) để được làm mới nền,
+      - ngược lại: coi như cache miss.
+    Nhờ vậy đổi định dạng dữ liệu không cần xóa toàn bộ cache và gây dồn request lên HUTECH.
+    """
+
+    def __init__(self):
+        self._schemas: Dict[str, NamespaceSchema] = {}
+        self.upgraded = 0
+        self.stale = 0
+        self.dropped = 0
+
+    def register(self, namespace: str, version: int, migrations: Optional[Dict[int, Callable[[Any], Any]]] = None,
+                 servable_from: Optional[int] = None):
+        """
+        Khai báo phiên bản định dạng dữ liệu của namespace.
+
+        Args:
+            namespace: Namespace của cache key.
+            version: Phiên bản hiện tại.
+            migrations: Phiên bản cũ -> hàm chuyển dữ liệu lên phiên bản kế tiếp (v -> v + 1).
+            servable_from: Phiên bản thấp nhất vẫn đọc được bởi code hiện tại (trả về như dữ liệu cũ).
+        """
+        self._schemas[namespace] = NamespaceSchema(version, migrations or {}, servable_from)
+
+    def stamp(self, key: str, envelope: Dict[str, Any]):
+        """Ghi phiên bản hiện tại của namespace vào envelope sắp lưu."""
+        schema = self._schemas.get(key.split(":", 1)[0])
+        if schema:
+            envelope["v"] = schema.version
+
+    def upgrade(self, key: str, envelope: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Đưa envelope đọc từ Redis về phiên bản hiện tại.
+
+        Returns:
+            Envelope dùng được (có thể đã bị đánh dấu stale), hoặc None nếu phải coi là cache miss.
+        """
+        schema = self._schemas.get(key.split(":", 1)[0])
+        if schema is None:
+            return envelope
+        version = envelope.get("v", DEFAULT_VERSION)
+        if version == schema.version:
+            return envelope
+        if version > schema.version:
+            # Ghi bởi instance chạy code mới hơn (đang rolling deploy)
+            self.dropped += 1
+            return None
+
+        data = envelope.get("data")
+        current = version
+        try:
+            while current < schema.version and current in schema.migrations:
+                data = schema.migrations[current](data)
+                current += 1
+        except Exception as e:
+            logger.error(f"Lỗi nâng cấp cache key '{key}' từ phiên bản {current}: {e}")
+            current = version
+
+        if current == schema.version:
+            self.upgraded += 1
+            envelope["data"] = data
+            envelope["v"] = current
+            return envelope
+        if schema.servable_from is not None and version >= schema.servable_from:
+            self.stale += 1
+            envelope["fresh_until"] = 0
+            return envelope
+        self.dropped += 1
+        logger.info(f"Bỏ qua cache key '{key}' phiên bản {version} (hiện tại {schema.version}).")
+        return None
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "versions": {namespace: schema.version for namespace, schema in self._schemas.items()},
+            "upgraded": self.upgraded,
+            "stale": self.stale,
+            "dropped": self.dropped,
+        }
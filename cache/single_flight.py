@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Gộp các lần gọi đồng thời cho cùng một key thành một lần thực thi (single-flight)
+"""
+
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict
+
+from utils import deadline
+
+logger = logging.getLogger(__name__)
+
+class SingleFlight:
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+        self.shared_count = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Thực thi fn cho key, hoặc chờ kết quả của lần thực thi đang diễn ra cho cùng key.
+
+        Args:
+            key: Khóa định danh lần gọi (thường là cache key).
+            fn: Hàm bất đồng bộ không tham số thực hiện công việc thật.
+
+        Returns:
+            Kết quả của fn, được chia sẻ cho tất cả các caller đồng thời.
+
+        Raises:
+            deadline.DeadlineExceeded: Nếu deadline của caller hết trước khi có kết quả
+                (lần thực thi dùng chung vẫn tiếp tục cho các caller khác).
+        """
+        task = self._calls.get(key)
+        if task is not None:
+            self.shared_count += 1
+            logger.info(f"Single-flight: dùng chung request đang chạy cho key: {key}")
+        else:
+            task = asyncio.create_task(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._on_done(key, t))
+
+        # shield để caller bị hủy không làm hủy request dùng chung của các caller khác
+        left = deadline.remaining()
+        if left is None:
+            return await asyncio.shield(task)
+        # Lần thực thi có thể do tác vụ nền (không deadline, ưu tiên thấp) khởi tạo:
+        # caller tương tác chỉ chờ trong phạm vi deadline của mình
+        try:
+            return await asyncio.wait_for(asyncio.shield(task), timeout=max(left, 0))
+        except asyncio.TimeoutError:
+            if task.done():
+                # Lỗi timeout của chính lần thực thi dùng chung
+                raise
+            raise deadline.DeadlineExceeded("Đã hết thời gian xử lý yêu cầu.")
+
+    def _on_done(self, key: str, task: asyncio.Task) -> None:
+        """Gỡ key khi lần thực thi kết thúc và đánh dấu exception đã được xử lý."""
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        if not task.cancelled():
+            task.exception()
+
+    def in_flight(self) -> int:
+        """Số lần thực thi đang diễn ra."""
+        return len(self._calls)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+TTL thích ứng theo namespace, dựa trên tần suất dữ liệu thực sự thay đổi giữa các lần lấy
+"""
+
+import hashlib
+import json
+import logging
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class TtlPolicy:
+    """
+    Mỗi namespace có TTL hiện tại nằm trong [min_ttl, max_ttl]. Mỗi lần một key được lấy lại,
+    fingerprint nội dung được so với lần trước: nếu không đổi thì tăng TTL (nhân increase_ratio),
+    nếu đổi thì giảm TTL (nhân decrease_ratio). Namespace có TTL cố định (override) không thay đổi.
+    """
+
+    def __init__(self, policies: Dict[str, Tuple[int, int, int]], overrides: Optional[Dict[str, int]] = None,
+                 default_ttl: int = 3600, increase_ratio: float = 1.25, decrease_ratio: float = 0.5,
+                 max_fingerprints: int = 10000):
+        """
+        Args:
+            policies: namespace -> (TTL ban đầu, TTL tối thiểu, TTL tối đa), tính bằng giây.
+            overrides: namespace -> TTL cố định, không điều chỉnh.
+            default_ttl: TTL cho namespace không có trong policies.
+        """
+        self.policies = policies
+        self.overrides = overrides or {}
+        self.default_ttl = default_ttl
+        self.increase_ratio = increase_ratio
+        self.decrease_ratio = decrease_ratio
+        self.max_fingerprints = max_fingerprints
+        self._ttls: Dict[str, float] = {namespace: float(policy[0]) for namespace, policy in policies.items()}
+        # key -> fingerprint của dữ liệu lần gần nhất (giới hạn số lượng theo LRU)
+        self._fingerprints: "OrderedDict[str, bytes]" = OrderedDict()
+        self.changes: Dict[str, int] = {namespace: 0 for namespace in policies}
+        self.unchanged: Dict[str, int] = {namespace: 0 for namespace in policies}
+
+    @staticmethod
+    def _fingerprint(value: Any) -> bytes:
+        body = json.dumps(value, sort_keys=True, ensure_ascii=False, default=str).encode("utf-8")
+        return hashlib.blake2b(body, digest_size=16).digest()
+
+    def get_ttl(self, namespace: str) -> int:
+        """TTL hiện tại của namespace."""
+        if namespace in self.overrides:
+            return self.overrides[namespace]
+        return int(self._ttls.get(namespace, self.default_ttl))
+
+    def observe(self, key: str, value: Any) -> int:
+        """
+        Ghi nhận dữ liệu mới lấy về cho key và trả về TTL nên dùng.
+
+        Args:
+            key: Khóa cache (namespace là phần trước dấu ':' đầu tiên).
+            value: Dữ liệu vừa lấy từ upstream.
+        """
+        namespace = key.split(":", 1)[0]
+        if namespace not in self.policies or namespace in self.overrides:
+            return self.get_ttl(namespace)
+
+        fingerprint = self._fingerprint(value)
+        previous = self._fingerprints.pop(key, None)
+        self._fingerprints[key] = fingerprint
+        if len(self._fingerprints) > self.max_fingerprints:
+            self._fingerprints.popitem(last=False)
+
+        if previous is not None:
+            _, min_ttl, max_ttl = self.policies[namespace]
+            old_ttl = self._ttls[namespace]
+            if previous == fingerprint:
+                self.unchanged[namespace] += 1
+                self._ttls[namespace] = min(max_ttl, old_ttl * self.increase_ratio)
+            else:
+                self.changes[namespace] += 1
+                self._ttls[namespace] = max(min_ttl, old_ttl * self.decrease_ratio)
+                if int(self._ttls[namespace]) != int(old_ttl):
+                    logger.info(f"Dữ liệu {namespace} thay đổi, giảm TTL: {int(old_ttl)}s -> {int(self._ttls[namespace])}s.")
+        return self.get_ttl(namespace)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            namespace: {
+                "ttl": self.get_ttl(namespace),
+                "changes": self.changes[namespace],
+                "unchanged": self.unchanged[namespace],
+                "override": namespace in self.overrides,
+            }
+            for namespace in self.policies
+        }
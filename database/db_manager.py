@@ -5,19 +5,66 @@
 Quản lý cơ sở dữ liệu PostgreSQL cho bot Telegram HUTECH
 """
 
+import asyncio
 import json
 import logging
+import time
 import asyncpg
-from typing import Dict, Any, Optional, List
+from contextlib import asynccontextmanager
+from typing import Dict, Any, Optional, List, AsyncIterator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 from config.config import Config
+from utils import deadline
 
 logger = logging.getLogger(__name__)
 
+# Các truy vấn chạy trên mọi lệnh, được prepare sẵn trên từng kết nối khi khởi động
+# (statement cache của asyncpg dùng nội dung câu truy vấn làm key)
+_SESSION_QUERY = '''
+    SELECT u.device_uuid, u.is_logged_in, lr.token, lr.old_token
+    FROM users u
+    LEFT JOIN login_responses lr ON lr.telegram_user_id = u.telegram_user_id
+    WHERE u.telegram_user_id = $1
+'''
+_USER_QUERY = "SELECT telegram_user_id, username, password, device_uuid, is_logged_in FROM users WHERE telegram_user_id = $1"
+_HOT_QUERIES = (_SESSION_QUERY, _USER_QUERY)
+
+def _json_dumps(value: Any) -> str:
+    if orjson:
+        return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+    return json.dumps(value, ensure_ascii=False)
+
+def _json_loads(value: str) -> Any:
+    return orjson.loads(value) if orjson else json.loads(value)
+
+def _extract_contact_id(response_data: Dict[str, Any]) -> Optional[str]:
+    """contact_id của response đăng nhập (ưu tiên trường gốc, sau đó old_login_info.result)."""
+    contact_id = response_data.get("contact_id")
+    if contact_id is None:
+        old_login_info = response_data.get("old_login_info")
+        result = old_login_info.get("result") if isinstance(old_login_info, dict) else None
+        if isinstance(result, dict):
+            contact_id = result.get("contact_id")
+    return str(contact_id) if contact_id is not None else None
+
 class DatabaseManager:
-    def __init__(self):
+    def __init__(self, cache_manager=None):
         self.config = Config()
         self.pool = None
+        # Cache phiên đăng nhập (L1 + Redis) để các lệnh không truy vấn database mỗi lần lấy token
+        self.cache_manager = cache_manager
+        # Tăng mỗi khi phiên của người dùng bị xóa khỏi cache, tránh ghi lại phiên đọc trước khi thay đổi
+        self._session_generations: Dict[int, int] = {}
+        # Thống kê thời gian chờ lấy kết nối từ pool
+        self.acquires = 0
+        self.acquire_timeouts = 0
+        self.acquire_wait_total = 0.0
+        self.acquire_wait_max = 0.0
 
     async def connect(self):
         """Khởi tạo connection pool đến PostgreSQL."""
@@ -25,11 +72,17 @@ class DatabaseManager:
             try:
                 self.pool = await asyncpg.create_pool(
                     dsn=self.config.POSTGRES_URL,
-                    min_size=5,
-                    max_size=20
+                    min_size=self.config.DB_POOL_MIN_SIZE,
+                    max_size=self.config.DB_POOL_MAX_SIZE,
+                    max_queries=self.config.DB_POOL_MAX_QUERIES,
+                    max_inactive_connection_lifetime=self.config.DB_POOL_MAX_INACTIVE_LIFETIME,
+                    # PgBouncer có thể chuyển mỗi transaction sang server khác, prepared statement không dùng lại được
+                    statement_cache_size=0 if self.config.DB_PGBOUNCER_MODE else self.config.DB_STATEMENT_CACHE_SIZE,
+                    init=self._init_connection
                 )
                 logger.info("Đã kết nối thành công đến PostgreSQL và tạo connection pool.")
                 await self._init_database()
+                await self._warm_up_pool()
             except Exception as e:
                 logger.error(f"Lỗi không thể kết nối đến PostgreSQL: {e}")
                 raise
@@ -40,6 +93,82 @@ class DatabaseManager:
             await self.pool.close()
             logger.info("Đã đóng connection pool của PostgreSQL.")
 
+    @staticmethod
+    async def _init_connection(conn: asyncpg.Connection):
+        """Đăng ký codec JSON/JSONB cho mỗi kết nối: truyền và nhận dict trực tiếp, không json.dumps/loads thủ công."""
+        for type_name in ("json", "jsonb"):
+            await conn.set_type_codec(
+                type_name, encoder=_json_dumps, decoder=_json_loads, schema="pg_catalog", format="text"
+            )
+
+    async def _warm_up_pool(self):
+        """
+        Prepare trước các truy vấn nóng trên từng kết nối của pool (create_pool đã mở sẵn min_size kết nối),
+        để loạt lệnh đầu tiên sau khi deploy không phải chờ prepare statement.
+        """
+        if self.config.DB_PGBOUNCER_MODE:
+            return
+        # Giữ đồng thời các kết nối để mỗi truy vấn được prepare trên từng kết nối khác nhau
+        connections = []
+        try:
+            for _ in range(self.pool.get_size()):
+                connections.append(await self.pool.acquire())
+            # Mỗi kết nối asyncpg chỉ chạy một thao tác một lúc: chạy tuần tự trong kết nối, song song giữa các kết nối
+            results = await asyncio.gather(
+                *(self._prepare_hot_queries(conn) for conn in connections), return_exceptions=True
+            )
+            failed = [result for result in results if isinstance(result, Exception)]
+            if failed:
+                logger.warning(f"Không thể prepare truy vấn trên {len(failed)} kết nối PostgreSQL: {failed[0]}")
+            logger.info(f"Đã prepare truy vấn nóng trên {len(connections) - len(failed)} kết nối PostgreSQL.")
+        except Exception as e:
+            logger.warning(f"Không thể làm nóng connection pool PostgreSQL: {e}")
+        finally:
+            for conn in connections:
+                await self.pool.release(conn)
+
+    @staticmethod
+    async def _prepare_hot_queries(conn: asyncpg.Connection):
+        for query in _HOT_QUERIES:
+            # fetchrow (không phải conn.prepare) để statement được lưu vào statement cache mà các truy vấn sau dùng lại;
+            # telegram_user_id = 0 không tồn tại nên không đọc dữ liệu nào
+            await conn.fetchrow(query, 0)
+
+    def _timeout(self) -> float:
+        """Timeout cho một thao tác database, giới hạn bởi deadline của update đang xử lý."""
+        return deadline.budget(self.config.DB_TIMEOUT)
+
+    @asynccontextmanager
+    async def _acquire(self) -> AsyncIterator[asyncpg.Connection]:
+        """Lấy kết nối từ pool (timeout theo deadline) và ghi nhận thời gian chờ."""
+        started = time.monotonic()
+        try:
+            conn = await self.pool.acquire(timeout=self._timeout())
+        except asyncio.TimeoutError:
+            self.acquire_timeouts += 1
+            raise
+        waited = time.monotonic() - started
+        self.acquires += 1
+        self.acquire_wait_total += waited
+        self.acquire_wait_max = max(self.acquire_wait_max, waited)
+        try:
+            yield conn
+        finally:
+            await self.pool.release(conn)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Thống kê connection pool và thời gian chờ lấy kết nối."""
+        return {
+            "size": self.pool.get_size() if self.pool else 0,
+            "idle": self.pool.get_idle_size() if self.pool else 0,
+            "min_size": self.config.DB_POOL_MIN_SIZE,
+            "max_size": self.config.DB_POOL_MAX_SIZE,
+            "acquires": self.acquires,
+            "acquire_timeouts": self.acquire_timeouts,
+            "wait_avg_ms": self.acquire_wait_total / self.acquires * 1000 if self.acquires else 0.0,
+            "wait_max_ms": self.acquire_wait_max * 1000,
+        }
+
     async def _init_database(self) -> None:
         """Khởi tạo cơ sở dữ liệu và tạo các bảng nếu chưa tồn tại."""
         async with self.pool.acquire() as conn:
@@ -66,6 +195,31 @@ class DatabaseManager:
                         UNIQUE(telegram_user_id)
                     )
                 ''')
+
+                # Token và contact_id được tách thành cột riêng để đọc không phải parse toàn bộ JSONB
+                await conn.execute('''
+                    ALTER TABLE login_responses
+                        ADD COLUMN IF NOT EXISTS token TEXT,
+                        ADD COLUMN IF NOT EXISTS old_token TEXT,
+                        ADD COLUMN IF NOT EXISTS contact_id TEXT
+                ''')
+                await conn.execute('''
+                    UPDATE login_responses SET
+                        token = response_data->>'token',
+                        old_token = response_data->'old_login_info'->>'token'
+                    WHERE token IS NULL AND response_data ? 'token'
+                ''')
+                await conn.execute('''
+                    UPDATE login_responses SET
+                        contact_id = COALESCE(
+                            response_data->>'contact_id',
+                            response_data->'old_login_info'->'result'->>'contact_id'
+                        )
+                    WHERE contact_id IS NULL AND (
+                        response_data ? 'contact_id'
+                        OR response_data->'old_login_info'->'result' ? 'contact_id'
+                    )
+                ''')
                 
                 # Các bảng khác sẽ được tạo tương tự khi cần
                 # Ví dụ cho tkb_responses
@@ -74,8 +228,15 @@ class DatabaseManager:
                 logger.error(f"Lỗi khởi tạo database: {e}")
                 raise
 
-    async def save_user(self, telegram_user_id: int, username: str, password: str, device_uuid: str) -> bool:
-        """Lưu hoặc cập nhật thông tin người dùng."""
+    async def save_user(self, telegram_user_id: int, username: str, password: str, device_uuid: str,
+                        invalidate_session: bool = True) -> bool:
+        """
+        Lưu hoặc cập nhật thông tin người dùng.
+
+        Args:
+            invalidate_session: False nếu caller sẽ gọi clear_user_cache ngay sau đó
+                (xóa phiên cùng toàn bộ cache của người dùng trong một pipeline).
+        """
         query = '''
             INSERT INTO users (telegram_user_id, username, password, device_uuid, is_logged_in, updated_at)
             VALUES ($1, $2, $3, $4, TRUE, CURRENT_TIMESTAMP)
@@ -87,27 +248,46 @@ class DatabaseManager:
                 updated_at = CURRENT_TIMESTAMP
         '''
         try:
-            async with self.pool.acquire() as conn:
-                await conn.execute(query, telegram_user_id, username, password, device_uuid)
+            async with self._acquire() as conn:
+                await conn.execute(query, telegram_user_id, username, password, device_uuid, timeout=self._timeout())
             logger.info(f"User {telegram_user_id} saved successfully")
+            if invalidate_session:
+                await self._invalidate_session(telegram_user_id)
             return True
         except Exception as e:
             logger.error(f"Error saving user {telegram_user_id}: {e}")
             return False
 
-    async def save_login_response(self, telegram_user_id: int, response_data: Dict[str, Any]) -> bool:
-        """Lưu response từ API đăng nhập."""
+    async def save_login_response(self, telegram_user_id: int, response_data: Dict[str, Any],
+                                  invalidate_session: bool = True) -> bool:
+        """
+        Lưu response từ API đăng nhập.
+
+        Args:
+            invalidate_session: False nếu caller sẽ gọi clear_user_cache ngay sau đó
+                (xóa phiên cùng toàn bộ cache của người dùng trong một pipeline).
+        """
         query = '''
-            INSERT INTO login_responses (telegram_user_id, response_data, created_at)
-            VALUES ($1, $2, CURRENT_TIMESTAMP)
+            INSERT INTO login_responses (telegram_user_id, response_data, token, old_token, contact_id, created_at)
+            VALUES ($1, $2, $3, $4, $5, CURRENT_TIMESTAMP)
             ON CONFLICT (telegram_user_id) DO UPDATE SET
                 response_data = EXCLUDED.response_data,
+                token = EXCLUDED.token,
+                old_token = EXCLUDED.old_token,
+                contact_id = EXCLUDED.contact_id,
                 created_at = CURRENT_TIMESTAMP
         '''
+        old_login_info = response_data.get("old_login_info")
+        old_token = old_login_info.get("token") if isinstance(old_login_info, dict) else None
         try:
-            async with self.pool.acquire() as conn:
-                await conn.execute(query, telegram_user_id, json.dumps(response_data))
+            async with self._acquire() as conn:
+                await conn.execute(
+                    query, telegram_user_id, response_data, response_data.get("token"), old_token,
+                    _extract_contact_id(response_data), timeout=self._timeout()
+                )
             logger.info(f"Login response for user {telegram_user_id} saved successfully")
+            if invalidate_session:
+                await self._invalidate_session(telegram_user_id)
             return True
         except Exception as e:
             logger.error(f"Error saving login response for user {telegram_user_id}: {e}")
@@ -115,10 +295,10 @@ class DatabaseManager:
 
     async def get_user(self, telegram_user_id: int) -> Optional[Dict[str, Any]]:
         """Lấy thông tin người dùng."""
-        query = "SELECT telegram_user_id, username, password, device_uuid, is_logged_in FROM users WHERE telegram_user_id = $1"
+        query = _USER_QUERY
         try:
-            async with self.pool.acquire() as conn:
-                user_data = await conn.fetchrow(query, telegram_user_id)
+            async with self._acquire() as conn:
+                user_data = await conn.fetchrow(query, telegram_user_id, timeout=self._timeout())
             if user_data:
                 return dict(user_data)
             return None
@@ -128,16 +308,25 @@ class DatabaseManager:
 
     async def is_user_logged_in(self, telegram_user_id: int) -> bool:
         """Kiểm tra xem người dùng đã đăng nhập chưa."""
-        user = await self.get_user(telegram_user_id)
-        return user is not None and user.get("is_logged_in", False)
+        session = await self.get_session(telegram_user_id)
+        return session is not None and session["is_logged_in"]
+
+    async def set_user_login_status(self, telegram_user_id: int, is_logged_in: bool,
+                                    invalidate_session: bool = True) -> bool:
+        """
+        Cập nhật trạng thái đăng nhập của người dùng.
 
-    async def set_user_login_status(self, telegram_user_id: int, is_logged_in: bool) -> bool:
-        """Cập nhật trạng thái đăng nhập của người dùng."""
+        Args:
+            invalidate_session: False nếu caller sẽ gọi clear_user_cache ngay sau đó
+                (xóa phiên cùng toàn bộ cache của người dùng trong một pipeline).
+        """
         query = "UPDATE users SET is_logged_in = $1, updated_at = CURRENT_TIMESTAMP WHERE telegram_user_id = $2"
         try:
-            async with self.pool.acquire() as conn:
-                await conn.execute(query, is_logged_in, telegram_user_id)
+            async with self._acquire() as conn:
+                await conn.execute(query, is_logged_in, telegram_user_id, timeout=self._timeout())
             logger.info(f"User {telegram_user_id} login status updated to {is_logged_in}")
+            if invalidate_session:
+                await self._invalidate_session(telegram_user_id)
             return True
         except Exception as e:
             logger.error(f"Error updating login status for user {telegram_user_id}: {e}")
@@ -147,22 +336,91 @@ class DatabaseManager:
         """Lấy response đăng nhập gần nhất của người dùng."""
         query = "SELECT response_data FROM login_responses WHERE telegram_user_id = $1"
         try:
-            async with self.pool.acquire() as conn:
-                record = await conn.fetchrow(query, telegram_user_id)
+            async with self._acquire() as conn:
+                record = await conn.fetchrow(query, telegram_user_id, timeout=self._timeout())
             if record and record['response_data']:
-                return json.loads(record['response_data'])
+                # JSONB được codec của pool giải mã thành dict
+                return record['response_data']
             return None
         except Exception as e:
             logger.error(f"Error getting login response for user {telegram_user_id}: {e}")
             return None
 
+    async def get_session(self, telegram_user_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Lấy phiên đăng nhập của người dùng, ưu tiên từ cache.
+
+        Returns:
+            Dict gồm token, old_token (token của old_login_info), device_uuid và is_logged_in;
+            None nếu người dùng chưa từng đăng nhập hoặc có lỗi.
+        """
+        if not self.cache_manager:
+            return await self._load_session(telegram_user_id)
+
+        key = self.cache_manager.user_key("session", telegram_user_id)
+        cached = await self.cache_manager.get(key)
+        if cached:
+            return cached["data"]
+        return await self.cache_manager.single_flight.do(key, lambda: self._load_and_cache_session(telegram_user_id, key))
+
+    async def _load_and_cache_session(self, telegram_user_id: int, key: str) -> Optional[Dict[str, Any]]:
+        generation = self._session_generations.get(telegram_user_id, 0)
+        try:
+            session = await self._read_session(telegram_user_id)
+        except Exception as e:
+            logger.error(f"Error getting session for user {telegram_user_id}: {e}")
+            return None
+
+        if generation == self._session_generations.get(telegram_user_id, 0):
+            # Người dùng chưa đăng nhập cũng được cache (ngắn hơn) để không truy vấn lại mỗi lệnh
+            ttl = self.config.CACHE_SESSION_TTL if session else self.config.CACHE_NEGATIVE_SESSION_TTL
+            await self.cache_manager.set(key, session, ttl=ttl)
+        return session
+
+    async def _load_session(self, telegram_user_id: int) -> Optional[Dict[str, Any]]:
+        try:
+            return await self._read_session(telegram_user_id)
+        except Exception as e:
+            logger.error(f"Error getting session for user {telegram_user_id}: {e}")
+            return None
+
+    async def _read_session(self, telegram_user_id: int) -> Optional[Dict[str, Any]]:
+        """Đọc phiên đăng nhập từ database bằng một truy vấn (lỗi được raise cho caller)."""
+        async with self._acquire() as conn:
+            record = await conn.fetchrow(_SESSION_QUERY, telegram_user_id, timeout=self._timeout())
+        if not record:
+            return None
+        return dict(record)
+
+    def _bump_session_generation(self, telegram_user_id: int):
+        self._session_generations[telegram_user_id] = self._session_generations.get(telegram_user_id, 0) + 1
+
+    async def _invalidate_session(self, telegram_user_id: int):
+        """Xóa phiên đã cache sau khi thông tin đăng nhập của người dùng thay đổi."""
+        if not self.cache_manager:
+            return
+        self._bump_session_generation(telegram_user_id)
+        await self.cache_manager.delete(self.cache_manager.user_key("session", telegram_user_id))
+
+    async def clear_user_cache(self, telegram_user_id: int):
+        """
+        Xóa phiên đăng nhập đã cache cùng toàn bộ cache của người dùng (đăng nhập/đăng xuất).
+        Key phiên nằm trong index của người dùng nên được xóa trong cùng pipeline với các key khác,
+        thay vì một lệnh DEL riêng cho mỗi lần ghi database.
+        """
+        if not self.cache_manager:
+            return
+        self._bump_session_generation(telegram_user_id)
+        await self.cache_manager.clear_user_cache(telegram_user_id)
+
     async def delete_user(self, telegram_user_id: int) -> bool:
         """Xóa người dùng và tất cả dữ liệu liên quan (sử dụng ON DELETE CASCADE)."""
         query = "DELETE FROM users WHERE telegram_user_id = $1"
         try:
-            async with self.pool.acquire() as conn:
-                await conn.execute(query, telegram_user_id)
+            async with self._acquire() as conn:
+                await conn.execute(query, telegram_user_id, timeout=self._timeout())
             logger.info(f"User {telegram_user_id} and all related data deleted successfully")
+            await self._invalidate_session(telegram_user_id)
             return True
         except Exception as e:
             logger.error(f"Error deleting user {telegram_user_id}: {e}")
@@ -172,8 +430,8 @@ class DatabaseManager:
         """Lấy danh sách ID của tất cả người dùng đang đăng nhập."""
         query = "SELECT telegram_user_id FROM users WHERE is_logged_in = TRUE"
         try:
-            async with self.pool.acquire() as conn:
-                records = await conn.fetch(query)
+            async with self._acquire() as conn:
+                records = await conn.fetch(query, timeout=self._timeout())
             return [record['telegram_user_id'] for record in records]
         except Exception as e:
             logger.error(f"Error getting all logged in users: {e}")
@@ -5,12 +5,14 @@
 Handler xử lý điểm danh từ hệ thống HUTECH
 """
 
+import asyncio
 import json
 import logging
 import aiohttp
 from typing import Dict, Any, Optional, List
 
 from config.config import Config
+from api.rate_limiter import Priority
 
 logger = logging.getLogger(__name__)
 
@@ -23,9 +25,11 @@ CAMPUS_LOCATIONS = {
 }
 
 class DiemDanhHandler:
-    def __init__(self, db_manager, cache_manager):
+    def __init__(self, db_manager, cache_manager, hutech_client, token_manager):
         self.db_manager = db_manager
         self.cache_manager = cache_manager
+        self.hutech_client = hutech_client
+        self.token_manager = token_manager
         self.config = Config()
     
     async def handle_diem_danh_menu(self, telegram_user_id: int) -> Dict[str, Any]:
@@ -39,10 +43,10 @@ class DiemDanhHandler:
             Dict chứa kết quả và dữ liệu menu
         """
         try:
-            # Lấy token của người dùng
-            token = await self._get_user_token(telegram_user_id)
+            # Kiểm tra người dùng đã đăng nhập (có token trong phiên)
+            session = await self._get_user_session(telegram_user_id)
             
-            if not token:
+            if not self.token_manager.session_token(session):
                 return {
                     "success": False,
                     "message": "Bạn chưa đăng nhập. Vui lòng sử dụng /login để đăng nhập.",
@@ -79,10 +83,10 @@ class DiemDanhHandler:
             Dict chứa kết quả và dữ liệu response
         """
         try:
-            # Lấy token của người dùng
-            token = await self._get_user_token(telegram_user_id)
+            # Phiên đăng nhập (token, device UUID) chỉ đọc một lần cho cả update
+            session = await self._get_user_session(telegram_user_id)
             
-            if not token:
+            if not self.token_manager.session_token(session):
                 return {
                     "success": False,
                     "message": "Bạn chưa đăng nhập. Vui lòng sử dụng /login để đăng nhập.",
@@ -100,7 +104,7 @@ class DiemDanhHandler:
             location = CAMPUS_LOCATIONS[campus_name]
             
             # Lấy device UUID
-            device_uuid = await self._get_user_device_uuid(telegram_user_id)
+            device_uuid = session["device_uuid"]
             if not device_uuid:
                 return {
                     "success": False,
@@ -108,8 +112,10 @@ class DiemDanhHandler:
                     "data": None
                 }
             
-            # Gọi API điểm danh
-            response_data = await self._call_diem_danh_api(token, code, device_uuid, location)
+            # Gọi API điểm danh (token hết hạn được làm mới và gọi lại một lần)
+            response_data = await self.token_manager.call(
+                telegram_user_id, self._call_diem_danh_api, code, device_uuid, location, session=session
+            )
             
             # Lưu response vào database
             save_data = {
@@ -182,8 +188,6 @@ class DiemDanhHandler:
             Response data từ API hoặc None nếu có lỗi
         """
         try:
-            url = f"{self.config.HUTECH_API_BASE_URL}{self.config.HUTECH_DIEM_DANH_SUBMIT_ENDPOINT}"
-            
             # Tạo headers
             headers = {
                 "user-agent": "Dart/3.5 (dart:io)",
@@ -204,34 +208,42 @@ class DiemDanhHandler:
                 }
             }
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    url,
-                    headers=headers,
-                    json=request_data
-                ) as response:
-                    if response.status == 200:
-                        return await response.json()
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"Điểm danh API error: {response.status} - {error_text}")
-                        try:
-                            # Thử parse JSON từ response
-                            error_json = await response.json()
-                            return {
-                                "error": True,
-                                "status_code": response.status,
-                                "message": error_json.get("reasons", {}).get("message", error_text),
-                                "full_response": error_json
-                            }
-                        except:
-                            # Nếu không phải JSON, trả về text
-                            return {
-                                "error": True,
-                                "status_code": response.status,
-                                "message": error_text
-                            }
+            async with self.hutech_client.request(
+                "POST",
+                self.config.HUTECH_DIEM_DANH_SUBMIT_ENDPOINT,
+                priority=Priority.CRITICAL, # Điểm danh không bao giờ phải chờ sau tác vụ nền
+                headers=headers,
+                json=request_data
+            ) as response:
+                if response.status == 200:
+                    return await response.json()
+                else:
+                    error_text = await response.text()
+                    logger.error(f"Điểm danh API error: {response.status} - {error_text}")
+                    try:
+                        # Thử parse JSON từ response
+                        error_json = await response.json()
+                        return {
+                            "error": True,
+                            "status_code": response.status,
+                            "message": error_json.get("reasons", {}).get("message", error_text),
+                            "full_response": error_json
+                        }
+                    except:
+                        # Nếu không phải JSON, trả về text
+                        return {
+                            "error": True,
+                            "status_code": response.status,
+                            "message": error_text
+                        }
         
+        except asyncio.TimeoutError:
+            logger.error("HUTECH API timeout")
+            return {
+                "error": True,
+                "timeout": True,
+                "message": "Hệ thống HUTECH phản hồi quá chậm, vui lòng thử lại sau."
+            }
         except aiohttp.ClientError as e:
             logger.error(f"HTTP client error: {e}")
             return {
@@ -268,39 +280,15 @@ class DiemDanhHandler:
             logger.error(f"Error saving điểm danh submit response for user {telegram_user_id}: {e}")
             return False
     
-    async def _get_user_token(self, telegram_user_id: int) -> Optional[str]:
+    async def _get_user_session(self, telegram_user_id: int) -> Optional[Dict[str, Any]]:
         """
-        Lấy token của người dùng từ database (ưu tiên token từ old_login_info cho các API cũ).
+        Lấy phiên đăng nhập (token, device UUID) của người dùng, đọc một lần cho mỗi update
         """
         try:
-            response_data = await self.db_manager.get_user_login_response(telegram_user_id)
-            if not response_data:
-                return None
-
-            # Ưu tiên sử dụng token từ old_login_info cho các API elearning cũ
-            old_login_info = response_data.get("old_login_info")
-            if isinstance(old_login_info, dict) and old_login_info.get("token"):
-                return old_login_info["token"]
-            
-            # Nếu không, sử dụng token chính
-            return response_data.get("token")
-
-        except Exception as e:
-            logger.error(f"Error getting token for user {telegram_user_id}: {e}")
-            return None
-    
-    async def _get_user_device_uuid(self, telegram_user_id: int) -> Optional[str]:
-        """
-        Lấy device UUID của người dùng từ database
-        """
-        try:
-            user = await self.db_manager.get_user(telegram_user_id)
-            if user:
-                return user.get("device_uuid")
-            return None
+            return await self.db_manager.get_session(telegram_user_id)
         
         except Exception as e:
-            logger.error(f"Error getting device UUID for user {telegram_user_id}: {e}")
+            logger.error(f"Error getting session for user {telegram_user_id}: {e}")
             return None
     
     def format_campus_menu_message(self) -> str:
@@ -5,6 +5,7 @@
 Handler xử lý điểm từ hệ thống HUTECH
 """
 
+import asyncio
 import json
 import logging
 import aiohttp
@@ -16,14 +17,22 @@ import openpyxl
 from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
 
 from config.config import Config
+from cache.fetch_engine import non_empty_list
 
 logger = logging.getLogger(__name__)
 
 class DiemHandler:
-    def __init__(self, db_manager, cache_manager):
+    def __init__(self, db_manager, cache_manager, hutech_client, token_manager):
         self.db_manager = db_manager
         self.cache_manager = cache_manager
+        self.hutech_client = hutech_client
+        self.token_manager = token_manager
         self.config = Config()
+        
+        # Nguồn dữ liệu cho cache-aside dùng chung
+        self.cache_manager.fetch_engine.register(
+            "diem", self._fetch_diem, validate=non_empty_list, stale_ttl=self.config.CACHE_STALE_TTL
+        )
     
     async def handle_diem(self, telegram_user_id: int, hocky_key: Optional[str] = None) -> Dict[str, Any]:
         """
@@ -37,63 +46,30 @@ class DiemHandler:
             Dict chứa kết quả và dữ liệu điểm
         """
         try:
-            cache_key = f"diem:{telegram_user_id}"
-
-            # 1. Kiểm tra cache
-            cached_result = await self.cache_manager.get(cache_key)
-            if cached_result:
-                diem_data = cached_result.get("data")
-                timestamp = cached_result.get("timestamp")
-                
-                processed_data = self._process_diem_data(diem_data, hocky_key)
-                processed_data["timestamp"] = timestamp
-
+            result = await self.cache_manager.fetch_engine.get_or_fetch(
+                "diem", telegram_user_id, process=lambda diem_data: self._process_diem_data(diem_data, hocky_key)
+            )
+            
+            if result["success"]:
                 return {
                     "success": True,
-                    "message": "Lấy điểm từ cache thành công",
-                    "data": processed_data
+                    "message": "Lấy điểm từ cache thành công" if result["from_cache"] else "Lấy điểm thành công (dữ liệu mới)",
+                    "data": result["data"]
                 }
-
-            # 2. Nếu cache miss, gọi API
-            token = await self._get_user_token(telegram_user_id)
             
-            if not token:
+            error = result["error"]
+            if error and error.get("not_logged_in"):
                 return {
                     "success": False,
-                    "message": "Bạn chưa đăng nhập. Vui lòng sử dụng /login để đăng nhập.",
+                    "message": error["message"],
                     "data": None
                 }
-            
-            response_data = await self._call_diem_api(token)
-            
-            # 3. Lưu vào cache
-            if response_data and isinstance(response_data, list):
-                await self.cache_manager.set(cache_key, response_data, ttl=86400) # Cache trong 24 giờ
-            
-            # Kiểm tra kết quả
-            if response_data and isinstance(response_data, list):
-                # Xử lý dữ liệu điểm
-                processed_data = self._process_diem_data(response_data, hocky_key)
-                
-                # Lấy timestamp từ cache manager để đồng bộ
-                cached_data = await self.cache_manager.get(cache_key)
-                if cached_data:
-                    processed_data["timestamp"] = cached_data.get("timestamp")
-                else:
-                    processed_data["timestamp"] = datetime.utcnow().isoformat()
-                
-                return {
-                    "success": True,
-                    "message": "Lấy điểm thành công (dữ liệu mới)",
-                    "data": processed_data
-                }
-            else:
-                return {
-                    "success": False,
-                    "message": "🚫 *Lỗi*\n\nKhông thể lấy dữ liệu điểm. Vui lòng thử lại sau.",
-                    "data": response_data,
-                    "show_back_button": True
-                }
+            return {
+                "success": False,
+                "message": "🚫 *Lỗi*\n\nKhông thể lấy dữ liệu điểm. Vui lòng thử lại sau.",
+                "data": error,
+                "show_back_button": True
+            }
         
         except Exception as e:
             logger.error(f"Điểm error for user {telegram_user_id}: {e}")
@@ -104,6 +80,19 @@ class DiemHandler:
                 "show_back_button": True
             }
     
+    async def _fetch_diem(self, telegram_user_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Lấy token và gọi API điểm (nguồn dữ liệu của namespace "diem")
+        
+        Args:
+            telegram_user_id: ID của người dùng trên Telegram
+            
+        Returns:
+            Response data từ API hoặc NOT_LOGGED_IN
+        """
+        # Token hết hạn (401) được làm mới và gọi lại một lần
+        return await self.token_manager.call(telegram_user_id, self._call_diem_api)
+    
     async def _call_diem_api(self, token: str) -> Optional[Dict[str, Any]]:
         """
         Gọi API điểm của HUTECH
@@ -115,29 +104,34 @@ class DiemHandler:
             Response data từ API hoặc None nếu có lỗi
         """
         try:
-            url = f"{self.config.HUTECH_API_BASE_URL}{self.config.HUTECH_DIEM_ENDPOINT}"
-            
             # Tạo headers riêng cho API điểm
             headers = self.config.HUTECH_MOBILE_HEADERS.copy()
             headers["authorization"] = f"JWT {token}"
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    url,
-                    headers=headers,
-                    json={}  # Request body rỗng theo tài liệu
-                ) as response:
-                    if response.status == 201:
-                        return await response.json()
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"Điểm API error: {response.status} - {error_text}")
-                        return {
-                            "error": True,
-                            "status_code": response.status,
-                            "message": error_text
-                        }
+            async with self.hutech_client.request(
+                "POST",
+                self.config.HUTECH_DIEM_ENDPOINT,
+                headers=headers,
+                json={}  # Request body rỗng theo tài liệu
+            ) as response:
+                if response.status == 201:
+                    return await response.json()
+                else:
+                    error_text = await response.text()
+                    logger.error(f"Điểm API error: {response.status} - {error_text}")
+                    return {
+                        "error": True,
+                        "status_code": response.status,
+                        "message": error_text
+                    }
         
+        except asyncio.TimeoutError:
+            logger.error("HUTECH API timeout")
+            return {
+                "error": True,
+                "timeout": True,
+                "message": "Hệ thống HUTECH phản hồi quá chậm, vui lòng thử lại sau."
+            }
         except aiohttp.ClientError as e:
             logger.error(f"HTTP client error: {e}")
             return {
@@ -176,27 +170,6 @@ class DiemHandler:
             logger.error(f"Error saving điểm response for user {telegram_user_id}: {e}")
             return False
     
-    async def _get_user_token(self, telegram_user_id: int) -> Optional[str]:
-        """
-        Lấy token của người dùng từ database (ưu tiên token từ old_login_info cho các API cũ).
-        """
-        try:
-            response_data = await self.db_manager.get_user_login_response(telegram_user_id)
-            if not response_data:
-                return None
-
-            # Ưu tiên sử dụng token từ old_login_info cho các API elearning cũ
-            old_login_info = response_data.get("old_login_info")
-            if isinstance(old_login_info, dict) and old_login_info.get("token"):
-                return old_login_info["token"]
-            
-            # Nếu không, sử dụng token chính
-            return response_data.get("token")
-
-        except Exception as e:
-            logger.error(f"Error getting token for user {telegram_user_id}: {e}")
-            return None
-    
     def _process_diem_data(self, diem_data: List[Dict[str, Any]], hocky_key: Optional[str] = None) -> Dict[str, Any]:
         """
         Xử lý dữ liệu điểm
@@ -5,6 +5,7 @@
 Handler xử lý học phần từ hệ thống HUTECH
 """
 
+import asyncio
 import json
 import logging
 import aiohttp
@@ -16,14 +17,28 @@ import openpyxl
 from openpyxl.styles import Font, Alignment, PatternFill
 
 from config.config import Config
+from api.rate_limiter import Priority
+from cache.fetch_engine import NOT_LOGGED_IN, non_empty_list
 
 logger = logging.getLogger(__name__)
 
 class HocPhanHandler:
-    def __init__(self, db_manager, cache_manager):
+    def __init__(self, db_manager, cache_manager, hutech_client, token_manager):
         self.db_manager = db_manager
         self.cache_manager = cache_manager
+        self.hutech_client = hutech_client
+        self.token_manager = token_manager
         self.config = Config()
+        
+        # Nguồn dữ liệu cho cache-aside dùng chung
+        fetch_engine = self.cache_manager.fetch_engine
+        fetch_engine.register(
+            "nam_hoc_hoc_ky", self._fetch_nam_hoc_hoc_ky, validate=non_empty_list, stale_ttl=self.config.CACHE_STALE_TTL
+        )
+        fetch_engine.register("search_hoc_phan", self._fetch_search_hoc_phan, validate=non_empty_list)
+        fetch_engine.register(
+            "diem_danh", self._fetch_diem_danh, validate=lambda diem_danh_list: isinstance(diem_danh_list, list)
+        )
     
     async def handle_hoc_phan(self, telegram_user_id: int) -> Dict[str, Any]:
         """
@@ -36,56 +51,29 @@ class HocPhanHandler:
             Dict chứa kết quả và dữ liệu năm học - học kỳ
         """
         try:
-            cache_key = f"nam_hoc_hoc_ky:{telegram_user_id}"
-
-            # 1. Kiểm tra cache
-            cached_result = await self.cache_manager.get(cache_key)
-            if cached_result:
-                nam_hoc_data = cached_result.get("data")
-                timestamp = cached_result.get("timestamp")
-
-                processed_data = self._process_nam_hoc_hoc_ky_data(nam_hoc_data)
-                processed_data["timestamp"] = timestamp
-
+            result = await self.cache_manager.fetch_engine.get_or_fetch(
+                "nam_hoc_hoc_ky", telegram_user_id, process=self._process_nam_hoc_hoc_ky_data
+            )
+            
+            if result["success"]:
                 return {
                     "success": True,
-                    "message": "Lấy danh sách năm học - học kỳ thành công",
-                    "data": processed_data
+                    "message": "Lấy danh sách năm học - học kỳ thành công" if result["from_cache"] else "Lấy danh sách năm học - học kỳ thành công (dữ liệu mới)",
+                    "data": result["data"]
                 }
-
-            # 2. Nếu cache miss, gọi API
-            token = await self._get_user_token(telegram_user_id)
             
-            if not token:
+            error = result["error"]
+            if error and error.get("not_logged_in"):
                 return {
                     "success": False,
-                    "message": "Bạn chưa đăng nhập. Vui lòng sử dụng /login để đăng nhập.",
+                    "message": error["message"],
                     "data": None
                 }
-            
-            response_data = await self._call_nam_hoc_hoc_ky_api(token)
-            
-            # 3. Lưu vào cache
-            if response_data and isinstance(response_data, list):
-                await self.cache_manager.set(cache_key, response_data, ttl=86400) # Cache trong 24 giờ
-            
-            # Kiểm tra kết quả
-            if response_data and isinstance(response_data, list):
-                # Xử lý dữ liệu năm học - học kỳ
-                processed_data = self._process_nam_hoc_hoc_ky_data(response_data)
-                processed_data["timestamp"] = datetime.utcnow().isoformat() # Thêm timestamp mới
-                
-                return {
-                    "success": True,
-                    "message": "Lấy danh sách năm học - học kỳ thành công (dữ liệu mới)",
-                    "data": processed_data
-                }
-            else:
-                return {
-                    "success": False,
-                    "message": "🚫 *Lỗi*\n\nKhông thể lấy danh sách năm học - học kỳ. Vui lòng thử lại sau.",
-                    "data": response_data
-                }
+            return {
+                "success": False,
+                "message": "🚫 *Lỗi*\n\nKhông thể lấy danh sách năm học - học kỳ. Vui lòng thử lại sau.",
+                "data": error
+            }
         
         except Exception as e:
             logger.error(f"Học phần error for user {telegram_user_id}: {e}")
@@ -107,53 +95,31 @@ class HocPhanHandler:
             Dict chứa kết quả và dữ liệu học phần
         """
         try:
-            # Tạo cache key dựa trên user_id và danh sách năm học
-            cache_key = f"search_hoc_phan:{telegram_user_id}:{':'.join(sorted(nam_hoc_hoc_ky_list))}"
-
-            # 1. Kiểm tra cache
-            cached_result = await self.cache_manager.get(cache_key)
-            if cached_result:
-                processed_data = self._process_search_hoc_phan_data(cached_result.get("data", []))
+            # Cache key dựa trên user_id và danh sách năm học (đã sắp xếp)
+            result = await self.cache_manager.fetch_engine.get_or_fetch(
+                "search_hoc_phan", telegram_user_id, *sorted(nam_hoc_hoc_ky_list),
+                process=self._process_search_hoc_phan_data
+            )
+            
+            if result["success"]:
                 return {
                     "success": True,
-                    "message": "Tìm kiếm học phần thành công (từ cache)",
-                    "data": processed_data
+                    "message": "Tìm kiếm học phần thành công (từ cache)" if result["from_cache"] else "Tìm kiếm học phần thành công",
+                    "data": result["data"]
                 }
-
-            # 2. Nếu cache miss, gọi API
-            token = await self._get_user_token(telegram_user_id)
             
-            if not token:
+            error = result["error"]
+            if error and error.get("not_logged_in"):
                 return {
                     "success": False,
-                    "message": "Bạn chưa đăng nhập. Vui lòng sử dụng /login để đăng nhập.",
+                    "message": error["message"],
                     "data": None
                 }
-            
-            response_data = await self._call_search_hoc_phan_api(token, nam_hoc_hoc_ky_list)
-            
-            # 3. Lưu vào cache nếu thành công
-            if response_data and isinstance(response_data, list):
-                await self.cache_manager.set(cache_key, response_data, ttl=3600) # Cache trong 1 giờ
-            
-            # Kiểm tra kết quả
-            if response_data and isinstance(response_data, list):
-                # Xử lý dữ liệu học phần
-                # Xử lý dữ liệu học phần
-                processed_data = self._process_search_hoc_phan_data(response_data)
-                processed_data["timestamp"] = datetime.utcnow().isoformat()
-                
-                return {
-                    "success": True,
-                    "message": "Tìm kiếm học phần thành công",
-                    "data": processed_data
-                }
-            else:
-                return {
-                    "success": False,
-                    "message": "🚫 *Lỗi*: Không thể tìm kiếm học phần. Vui lòng thử lại sau.",
-                    "data": response_data
-                }
+            return {
+                "success": False,
+                "message": "🚫 *Lỗi*: Không thể tìm kiếm học phần. Vui lòng thử lại sau.",
+                "data": error
+            }
         
         except Exception as e:
             logger.error(f"Search học phần error for user {telegram_user_id}: {e}")
@@ -175,68 +141,46 @@ class HocPhanHandler:
             Dict chứa kết quả và dữ liệu điểm danh
         """
         try:
-            cache_key = f"diem_danh:{telegram_user_id}:{key_lop_hoc_phan}"
+            result = await self.cache_manager.fetch_engine.get_or_fetch(
+                "diem_danh", telegram_user_id, key_lop_hoc_phan, process=self._process_diem_danh_data
+            )
 
-            # 1. Kiểm tra cache
-            cached_result = await self.cache_manager.get(cache_key)
-            if cached_result:
-                processed_data = self._process_diem_danh_data(cached_result.get("data", []))
+            if result["success"]:
                 return {
                     "success": True,
-                    "message": "Lấy lịch sử điểm danh thành công (từ cache)",
-                    "data": processed_data
+                    "message": "Lấy lịch sử điểm danh thành công (từ cache)" if result["from_cache"] else "Lấy lịch sử điểm danh thành công",
+                    "data": result["data"]
                 }
-
-            # 2. Nếu cache miss, gọi API
-            token = await self._get_user_token(telegram_user_id)
             
-            if not token:
+            response_data = result["error"]
+            if response_data and response_data.get("not_logged_in"):
                 return {
                     "success": False,
-                    "message": "Bạn chưa đăng nhập. Vui lòng sử dụng /login để đăng nhập.",
+                    "message": response_data["message"],
                     "data": None
                 }
             
-            response_data = await self._call_diem_danh_api(token, key_lop_hoc_phan)
-            
-            # 3. Lưu vào cache nếu thành công
-            if response_data and isinstance(response_data, dict) and "result" in response_data:
-                await self.cache_manager.set(cache_key, response_data["result"], ttl=3600) # Cache trong 1 giờ
-
-            # Kiểm tra kết quả
-            if response_data and isinstance(response_data, dict) and "result" in response_data:
-                # Xử lý dữ liệu điểm danh
-                diem_danh_list = response_data["result"]
-                processed_data = self._process_diem_danh_data(diem_danh_list)
-                processed_data["timestamp"] = datetime.utcnow().isoformat()
-                
-                return {
-                    "success": True,
-                    "message": "Lấy lịch sử điểm danh thành công",
-                    "data": processed_data
-                }
-            else:
-                # Xử lý lỗi từ API
-                error_message = "Danh sách điểm danh chưa được cập nhật"
-                if response_data and response_data.get("error"):
-                    try:
-                        # Thử parse message nếu nó là JSON string
-                        api_error_details = json.loads(response_data.get("message", "{}"))
-                        # Ưu tiên lấy message từ reasons, sau đó là errorMessage
-                        extracted_message = api_error_details.get("reasons", {}).get("message") or api_error_details.get("errorMessage")
-                        if extracted_message:
-                             error_message = extracted_message.split(" - ", 1)[-1] # Lấy phần thông báo lỗi chính
-                    except (json.JSONDecodeError, AttributeError):
-                        # Nếu message không phải JSON hoặc không có cấu trúc mong đợi, sử dụng message gốc
-                        if isinstance(response_data.get("message"), str):
-                            error_message = response_data["message"]
+            # Xử lý lỗi từ API
+            error_message = "Danh sách điểm danh chưa được cập nhật"
+            if response_data and response_data.get("error"):
+                try:
+                    # Thử parse message nếu nó là JSON string
+                    api_error_details = json.loads(response_data.get("message", "{}"))
+                    # Ưu tiên lấy message từ reasons, sau đó là errorMessage
+                    extracted_message = api_error_details.get("reasons", {}).get("message") or api_error_details.get("errorMessage")
+                    if extracted_message:
+                         error_message = extracted_message.split(" - ", 1)[-1] # Lấy phần thông báo lỗi chính
+                except (json.JSONDecodeError, AttributeError):
+                    # Nếu message không phải JSON hoặc không có cấu trúc mong đợi, sử dụng message gốc
+                    if isinstance(response_data.get("message"), str):
+                        error_message = response_data["message"]
 
-                logger.warning(f"Invalid response data or API error: {response_data}")
-                return {
-                    "success": False,
-                    "message": f"🚫 *Lỗi*\n\n{error_message}",
-                    "data": response_data
-                }
+            logger.warning(f"Invalid response data or API error: {response_data}")
+            return {
+                "success": False,
+                "message": f"🚫 *Lỗi*\n\n{error_message}",
+                "data": response_data
+            }
         
         except Exception as e:
             logger.error(f"Điểm danh error for user {telegram_user_id}: {e}", exc_info=True)
@@ -258,19 +202,18 @@ class HocPhanHandler:
             Dict chứa kết quả và dữ liệu danh sách sinh viên
         """
         try:
-            # Lấy token của người dùng
-            token = await self._get_user_token(telegram_user_id)
+            # Gọi API danh sách sinh viên (token hết hạn được làm mới và gọi lại một lần)
+            response_data = await self.token_manager.call(
+                telegram_user_id, self._call_danh_sach_sinh_vien_api, key_lop_hoc_phan
+            )
             
-            if not token:
+            if response_data is NOT_LOGGED_IN:
                 return {
                     "success": False,
-                    "message": "Bạn chưa đăng nhập. Vui lòng sử dụng /login để đăng nhập.",
+                    "message": NOT_LOGGED_IN["message"],
                     "data": None
                 }
             
-            # Gọi API danh sách sinh viên
-            response_data = await self._call_danh_sach_sinh_vien_api(token, key_lop_hoc_phan)
-            
             # Kiểm tra kết quả
             if response_data and isinstance(response_data, dict):
                 # Xử lý dữ liệu danh sách sinh viên
@@ -296,6 +239,49 @@ class HocPhanHandler:
                 "data": None
             }
     
+    async def _fetch_nam_hoc_hoc_ky(self, telegram_user_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Lấy token và gọi API năm học - học kỳ (nguồn dữ liệu của namespace "nam_hoc_hoc_ky")
+        
+        Args:
+            telegram_user_id: ID của người dùng trên Telegram
+            
+        Returns:
+            Response data từ API hoặc NOT_LOGGED_IN
+        """
+        # Token hết hạn (401) được làm mới và gọi lại một lần
+        return await self.token_manager.call(telegram_user_id, self._call_nam_hoc_hoc_ky_api)
+    
+    async def _fetch_search_hoc_phan(self, telegram_user_id: int, *nam_hoc_hoc_ky_list: str) -> Optional[Dict[str, Any]]:
+        """
+        Lấy token và gọi API tìm kiếm học phần (nguồn dữ liệu của namespace "search_hoc_phan")
+        
+        Args:
+            telegram_user_id: ID của người dùng trên Telegram
+            nam_hoc_hoc_ky_list: Các mã năm học - học kỳ (phần bổ sung của cache key)
+            
+        Returns:
+            Response data từ API hoặc NOT_LOGGED_IN
+        """
+        # Token hết hạn (401) được làm mới và gọi lại một lần
+        return await self.token_manager.call(telegram_user_id, self._call_search_hoc_phan_api, list(nam_hoc_hoc_ky_list))
+    
+    async def _fetch_diem_danh(self, telegram_user_id: int, key_lop_hoc_phan: str) -> Optional[Any]:
+        """
+        Lấy token và gọi API điểm danh (nguồn dữ liệu của namespace "diem_danh")
+        
+        Args:
+            telegram_user_id: ID của người dùng trên Telegram
+            key_lop_hoc_phan: Khóa lớp học phần
+            
+        Returns:
+            Danh sách điểm danh ("result" của response), dict lỗi hoặc NOT_LOGGED_IN
+        """
+        response_data = await self.token_manager.call(telegram_user_id, self._call_diem_danh_api, key_lop_hoc_phan)
+        if isinstance(response_data, dict) and "result" in response_data:
+            return response_data["result"]
+        return response_data
+    
     async def _call_nam_hoc_hoc_ky_api(self, token: str) -> Optional[Dict[str, Any]]:
         """
         Gọi API lấy danh sách năm học - học kỳ của HUTECH
@@ -307,28 +293,33 @@ class HocPhanHandler:
             Response data từ API hoặc None nếu có lỗi
         """
         try:
-            url = f"{self.config.HUTECH_API_BASE_URL}{self.config.HUTECH_HOC_PHAN_NAM_HOC_HOC_KY_ENDPOINT}"
-            
             # Tạo headers riêng cho API học phần
             headers = self.config.HUTECH_MOBILE_HEADERS.copy()
             headers["authorization"] = f"JWT {token}"
             
-            async with aiohttp.ClientSession() as session:
-                async with session.get(
-                    url,
-                    headers=headers
-                ) as response:
-                    if response.status == 200:
-                        return await response.json()
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"Năm học - học kỳ API error: {response.status} - {error_text}")
-                        return {
-                            "error": True,
-                            "status_code": response.status,
-                            "message": error_text
-                        }
+            async with self.hutech_client.request(
+                "GET",
+                self.config.HUTECH_HOC_PHAN_NAM_HOC_HOC_KY_ENDPOINT,
+                headers=headers
+            ) as response:
+                if response.status == 200:
+                    return await response.json()
+                else:
+                    error_text = await response.text()
+                    logger.error(f"Năm học - học kỳ API error: {response.status} - {error_text}")
+                    return {
+                        "error": True,
+                        "status_code": response.status,
+                        "message": error_text
+                    }
         
+        except asyncio.TimeoutError:
+            logger.error("HUTECH API timeout")
+            return {
+                "error": True,
+                "timeout": True,
+                "message": "Hệ thống HUTECH phản hồi quá chậm, vui lòng thử lại sau."
+            }
         except aiohttp.ClientError as e:
             logger.error(f"HTTP client error: {e}")
             return {
@@ -360,8 +351,6 @@ class HocPhanHandler:
             Response data từ API hoặc None nếu có lỗi
         """
         try:
-            url = f"{self.config.HUTECH_API_BASE_URL}{self.config.HUTECH_HOC_PHAN_SEARCH_ENDPOINT}"
-            
             # Tạo headers riêng cho API học phần
             headers = self.config.HUTECH_MOBILE_HEADERS.copy()
             headers["authorization"] = f"JWT {token}"
@@ -371,23 +360,30 @@ class HocPhanHandler:
                 "nam_hoc_hoc_ky": nam_hoc_hoc_ky_list
             }
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    url,
-                    headers=headers,
-                    json=request_body
-                ) as response:
-                    if response.status == 200:
-                        return await response.json()
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"Search học phần API error: {response.status} - {error_text}")
-                        return {
-                            "error": True,
-                            "status_code": response.status,
-                            "message": error_text
-                        }
+            async with self.hutech_client.request(
+                "POST",
+                self.config.HUTECH_HOC_PHAN_SEARCH_ENDPOINT,
+                headers=headers,
+                json=request_body
+            ) as response:
+                if response.status == 200:
+                    return await response.json()
+                else:
+                    error_text = await response.text()
+                    logger.error(f"Search học phần API error: {response.status} - {error_text}")
+                    return {
+                        "error": True,
+                        "status_code": response.status,
+                        "message": error_text
+                    }
         
+        except asyncio.TimeoutError:
+            logger.error("HUTECH API timeout")
+            return {
+                "error": True,
+                "timeout": True,
+                "message": "Hệ thống HUTECH phản hồi quá chậm, vui lòng thử lại sau."
+            }
         except aiohttp.ClientError as e:
             logger.error(f"HTTP client error: {e}")
             return {
@@ -419,8 +415,6 @@ class HocPhanHandler:
             Response data từ API hoặc None nếu có lỗi
         """
         try:
-            url = f"{self.config.HUTECH_API_BASE_URL}{self.config.HUTECH_HOC_PHAN_DIEM_DANH_ENDPOINT}"
-            
             # Tạo headers riêng cho API học phần
             headers = self.config.HUTECH_MOBILE_HEADERS.copy()
             headers["authorization"] = f"JWT {token}"
@@ -430,25 +424,32 @@ class HocPhanHandler:
                 "key_lop_hoc_phan": key_lop_hoc_phan
             }
             
-            async with aiohttp.ClientSession() as session:
-                async with session.get(
-                    url,
-                    headers=headers,
-                    params=params
-                ) as response:
+            async with self.hutech_client.request(
+                "GET",
+                self.config.HUTECH_HOC_PHAN_DIEM_DANH_ENDPOINT,
+                headers=headers,
+                params=params
+            ) as response:
                     
-                    if response.status == 200:
-                        response_data = await response.json()
-                        return response_data
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"Điểm danh API error: {response.status} - {error_text}")
-                        return {
-                            "error": True,
-                            "status_code": response.status,
-                            "message": error_text
-                        }
+                if response.status == 200:
+                    response_data = await response.json()
+                    return response_data
+                else:
+                    error_text = await response.text()
+                    logger.error(f"Điểm danh API error: {response.status} - {error_text}")
+                    return {
+                        "error": True,
+                        "status_code": response.status,
+                        "message": error_text
+                    }
         
+        except asyncio.TimeoutError:
+            logger.error("HUTECH API timeout")
+            return {
+                "error": True,
+                "timeout": True,
+                "message": "Hệ thống HUTECH phản hồi quá chậm, vui lòng thử lại sau."
+            }
         except aiohttp.ClientError as e:
             logger.error(f"HTTP client error: {e}")
             return {
@@ -480,8 +481,6 @@ class HocPhanHandler:
             Response data từ API hoặc None nếu có lỗi
         """
         try:
-            url = f"{self.config.HUTECH_API_BASE_URL}{self.config.HUTECH_HOC_PHAN_DANH_SACH_SINH_VIEN_ENDPOINT}"
-            
             # Tạo headers riêng cho API học phần
             headers = self.config.HUTECH_MOBILE_HEADERS.copy()
             headers["authorization"] = f"JWT {token}"
@@ -491,23 +490,31 @@ class HocPhanHandler:
                 "key_lop_hoc_phan": key_lop_hoc_phan
             }
             
-            async with aiohttp.ClientSession() as session:
-                async with session.get(
-                    url,
-                    headers=headers,
-                    params=params
-                ) as response:
-                    if response.status == 200:
-                        return await response.json()
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"Danh sách sinh viên API error: {response.status} - {error_text}")
-                        return {
-                            "error": True,
-                            "status_code": response.status,
-                            "message": error_text
-                        }
+            async with self.hutech_client.request(
+                "GET",
+                self.config.HUTECH_HOC_PHAN_DANH_SACH_SINH_VIEN_ENDPOINT,
+                priority=Priority.BACKGROUND, # Tải danh sách sinh viên nhường lượt cho các request quan trọng hơn
+                headers=headers,
+                params=params
+            ) as response:
+                if response.status == 200:
+                    return await response.json()
+                else:
+                    error_text = await response.text()
+                    logger.error(f"Danh sách sinh viên API error: {response.status} - {error_text}")
+                    return {
+                        "error": True,
+                        "status_code": response.status,
+                        "message": error_text
+                    }
         
+        except asyncio.TimeoutError:
+            logger.error("HUTECH API timeout")
+            return {
+                "error": True,
+                "timeout": True,
+                "message": "Hệ thống HUTECH phản hồi quá chậm, vui lòng thử lại sau."
+            }
         except aiohttp.ClientError as e:
             logger.error(f"HTTP client error: {e}")
             return {
@@ -528,27 +535,6 @@ class HocPhanHandler:
             }
     
     
-    async def _get_user_token(self, telegram_user_id: int) -> Optional[str]:
-        """
-        Lấy token của người dùng từ database (ưu tiên token từ old_login_info cho các API cũ).
-        """
-        try:
-            response_data = await self.db_manager.get_user_login_response(telegram_user_id)
-            if not response_data:
-                return None
-
-            # Ưu tiên sử dụng token từ old_login_info cho các API elearning cũ
-            old_login_info = response_data.get("old_login_info")
-            if isinstance(old_login_info, dict) and old_login_info.get("token"):
-                return old_login_info["token"]
-            
-            # Nếu không, sử dụng token chính
-            return response_data.get("token")
-
-        except Exception as e:
-            logger.error(f"Error getting token for user {telegram_user_id}: {e}")
-            return None
-    
     def _process_nam_hoc_hoc_ky_data(self, nam_hoc_hoc_ky_data: List[Dict[str, Any]]) -> Dict[str, Any]:
         """
         Xử lý dữ liệu năm học - học kỳ
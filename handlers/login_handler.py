@@ -5,6 +5,7 @@
 Handler xử lý đăng nhập vào hệ thống HUTECH
 """
 
+import asyncio
 import json
 import logging
 import aiohttp
@@ -15,9 +16,10 @@ from config.config import Config
 logger = logging.getLogger(__name__)
 
 class LoginHandler:
-    def __init__(self, db_manager, cache_manager):
+    def __init__(self, db_manager, cache_manager, hutech_client):
         self.db_manager = db_manager
         self.cache_manager = cache_manager
+        self.hutech_client = hutech_client
         self.config = Config()
     
     async def handle_login(self, telegram_user_id: int, username: str, password: str, device_uuid: str) -> Dict[str, Any]:
@@ -47,14 +49,21 @@ class LoginHandler:
             # Kiểm tra kết quả đăng nhập
             if response_data and "token" in response_data:
                 # 1. Lưu thông tin người dùng và cập nhật trạng thái đăng nhập
-                user_saved = await self.db_manager.save_user(telegram_user_id, username, password, device_uuid)
+                # (phiên đã cache được xóa một lần ở bước 3 thay vì sau mỗi lần ghi)
+                user_saved = await self.db_manager.save_user(
+                    telegram_user_id, username, password, device_uuid, invalidate_session=False
+                )
                 
                 # 2. Sau đó mới lưu response đăng nhập
-                response_saved = await self._save_login_response(telegram_user_id, response_data)
+                response_saved = await self._save_login_response(telegram_user_id, response_data, invalidate_session=False)
 
                 if user_saved and response_saved:
-                    # 3. Xóa cache cũ của người dùng để đảm bảo dữ liệu mới được lấy
-                    await self.cache_manager.clear_user_cache(telegram_user_id)
+                    # 3. Xóa phiên và cache cũ của người dùng (một pipeline Redis) để đảm bảo dữ liệu mới được lấy
+                    await self.db_manager.clear_user_cache(telegram_user_id)
+                    
+                    # 4. Lấy trước dữ liệu thường dùng trong nền để lệnh đầu tiên sau đăng nhập đọc từ cache
+                    if self.config.CACHE_WARMUP_ON_LOGIN:
+                        self.cache_manager.fetch_engine.warm_up(telegram_user_id, self.config.CACHE_WARMUP_NAMESPACES)
                     
                     return {
                         "success": True,
@@ -87,6 +96,32 @@ class LoginHandler:
                 "show_back_button": True
             }
     
+    async def refresh_session(self, telegram_user_id: int) -> bool:
+        """
+        Đăng nhập lại bằng thông tin đã lưu để lấy token mới (dùng bởi TokenManager).
+        Không xóa cache của người dùng như khi đăng nhập thủ công.
+        
+        Args:
+            telegram_user_id: ID của người dùng trên Telegram
+            
+        Returns:
+            True nếu đã lưu response đăng nhập mới
+        """
+        user = await self.db_manager.get_user(telegram_user_id)
+        if not user or not user.get("is_logged_in"):
+            return False
+        
+        response_data = await self._call_login_api({
+            "diuu": user["device_uuid"],
+            "username": user["username"],
+            "password": user["password"]
+        })
+        if response_data and "token" in response_data:
+            return await self._save_login_response(telegram_user_id, response_data)
+        
+        logger.warning(f"Không thể đăng nhập lại cho người dùng {telegram_user_id}: {response_data}")
+        return False
+    
     async def _call_login_api(self, request_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
         """
         Gọi API đăng nhập của HUTECH
@@ -98,26 +133,32 @@ class LoginHandler:
             Response data từ API hoặc None nếu có lỗi
         """
         try:
-            url = f"{self.config.HUTECH_API_BASE_URL}{self.config.HUTECH_LOGIN_ENDPOINT}"
             headers = self.config.HUTECH_STUDENT_HEADERS.copy()
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    url,
-                    headers=headers,
-                    json=request_data
-                ) as response:
-                    if response.status == 200:
-                        return await response.json()
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"Login API error: {response.status} - {error_text}")
-                        return {
-                            "error": True,
-                            "status_code": response.status,
-                            "message": error_text
-                        }
+            async with self.hutech_client.request(
+                "POST",
+                self.config.HUTECH_LOGIN_ENDPOINT,
+                headers=headers,
+                json=request_data
+            ) as response:
+                if response.status == 200:
+                    return await response.json()
+                else:
+                    error_text = await response.text()
+                    logger.error(f"Login API error: {response.status} - {error_text}")
+                    return {
+                        "error": True,
+                        "status_code": response.status,
+                        "message": error_text
+                    }
         
+        except asyncio.TimeoutError:
+            logger.error("HUTECH API timeout")
+            return {
+                "error": True,
+                "timeout": True,
+                "message": "Hệ thống HUTECH phản hồi quá chậm, vui lòng thử lại sau."
+            }
         except aiohttp.ClientError as e:
             logger.error(f"HTTP client error: {e}")
             return {
@@ -137,19 +178,23 @@ class LoginHandler:
                 "message": f"Lỗi không xác định: {str(e)}"
             }
     
-    async def _save_login_response(self, telegram_user_id: int, response_data: Dict[str, Any]) -> bool:
+    async def _save_login_response(self, telegram_user_id: int, response_data: Dict[str, Any],
+                                   invalidate_session: bool = True) -> bool:
         """
         Lưu response từ API đăng nhập vào database
         
         Args:
             telegram_user_id: ID của người dùng trên Telegram
             response_data: Dữ liệu response từ API
+            invalidate_session: Xóa phiên đã cache ngay sau khi lưu
             
         Returns:
             True nếu lưu thành công, False nếu có lỗi
         """
         try:
-            return await self.db_manager.save_login_response(telegram_user_id, response_data)
+            return await self.db_manager.save_login_response(
+                telegram_user_id, response_data, invalidate_session=invalidate_session
+            )
         except Exception as e:
             logger.error(f"Error saving login response for user {telegram_user_id}: {e}")
             return False
@@ -165,11 +210,10 @@ class LoginHandler:
             Token của người dùng hoặc None nếu không tìm thấy
         """
         try:
-            # Lấy response đăng nhập gần nhất của người dùng
-            response_data = await self.db_manager.get_user_login_response(telegram_user_id)
+            session = await self.db_manager.get_session(telegram_user_id)
             
-            if response_data and "token" in response_data:
-                return response_data["token"]
+            if session and session["token"]:
+                return session["token"]
             
             return None
         
@@ -188,9 +232,9 @@ class LoginHandler:
             Device UUID của người dùng hoặc None nếu không tìm thấy
         """
         try:
-            user = await self.db_manager.get_user(telegram_user_id)
-            if user:
-                return user.get("device_uuid")
+            session = await self.db_manager.get_session(telegram_user_id)
+            if session:
+                return session["device_uuid"]
             return None
         
         except Exception as e:
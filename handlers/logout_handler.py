@@ -5,6 +5,7 @@
 Handler xử lý đăng xuất khỏi hệ thống HUTECH
 """
 
+import asyncio
 import json
 import logging
 import aiohttp
@@ -15,9 +16,10 @@ from config.config import Config
 logger = logging.getLogger(__name__)
 
 class LogoutHandler:
-    def __init__(self, db_manager, cache_manager):
+    def __init__(self, db_manager, cache_manager, hutech_client):
         self.db_manager = db_manager
         self.cache_manager = cache_manager
+        self.hutech_client = hutech_client
         self.config = Config()
     
     async def handle_logout(self, telegram_user_id: int) -> Dict[str, Any]:
@@ -31,9 +33,11 @@ class LogoutHandler:
             Dict chứa kết quả đăng xuất
         """
         try:
-            # Lấy token và device UUID của người dùng
-            token = await self._get_user_token(telegram_user_id)
-            device_uuid = await self._get_user_device_uuid(telegram_user_id)
+            # Lấy token và device UUID của người dùng (một lần đọc phiên đăng nhập)
+            session = await self._get_user_session(telegram_user_id) or {}
+            # API đăng xuất cần token chính
+            token = session.get("token")
+            device_uuid = session.get("device_uuid")
             
             if not token:
                 # Tự động sửa lỗi: Nếu DB nói đã login nhưng không có token,
@@ -64,10 +68,10 @@ class LogoutHandler:
             # await self._save_logout_response(telegram_user_id, response_data)
             
             # Cập nhật trạng thái đăng nhập của người dùng
-            await self.db_manager.set_user_login_status(telegram_user_id, False)
+            await self.db_manager.set_user_login_status(telegram_user_id, False, invalidate_session=False)
             
-            # Xóa cache của người dùng
-            await self.cache_manager.clear_user_cache(telegram_user_id)
+            # Xóa phiên và cache của người dùng trong một pipeline Redis
+            await self.db_manager.clear_user_cache(telegram_user_id)
             
             # Kiểm tra kết quả đăng xuất
             if response_data and not response_data.get("error", False):
@@ -104,32 +108,38 @@ class LogoutHandler:
             Response data từ API hoặc None nếu có lỗi
         """
         try:
-            url = f"{self.config.HUTECH_API_BASE_URL}{self.config.HUTECH_LOGOUT_ENDPOINT}"
             headers = self.config.HUTECH_STUDENT_HEADERS.copy()
             headers["authorization"] = f"JWT {token}"
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    url,
-                    headers=headers,
-                    json=request_data
-                ) as response:
-                    if response.status == 200:
-                        # API đăng xuất trả về status 200 nhưng không có body
-                        return {
-                            "success": True,
-                            "status_code": response.status,
-                            "message": "Đăng xuất thành công"
-                        }
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"Logout API error: {response.status} - {error_text}")
-                        return {
-                            "error": True,
-                            "status_code": response.status,
-                            "message": error_text
-                        }
+            async with self.hutech_client.request(
+                "POST",
+                self.config.HUTECH_LOGOUT_ENDPOINT,
+                headers=headers,
+                json=request_data
+            ) as response:
+                if response.status == 200:
+                    # API đăng xuất trả về status 200 nhưng không có body
+                    return {
+                        "success": True,
+                        "status_code": response.status,
+                        "message": "Đăng xuất thành công"
+                    }
+                else:
+                    error_text = await response.text()
+                    logger.error(f"Logout API error: {response.status} - {error_text}")
+                    return {
+                        "error": True,
+                        "status_code": response.status,
+                        "message": error_text
+                    }
         
+        except asyncio.TimeoutError:
+            logger.error("HUTECH API timeout")
+            return {
+                "error": True,
+                "timeout": True,
+                "message": "Hệ thống HUTECH phản hồi quá chậm, vui lòng thử lại sau."
+            }
         except aiohttp.ClientError as e:
             logger.error(f"HTTP client error: {e}")
             return {
@@ -165,40 +175,15 @@ class LogoutHandler:
         logger.warning("save_logout_response is not implemented in the new db_manager.")
         return True
     
-    async def _get_user_token(self, telegram_user_id: int) -> Optional[str]:
+    async def _get_user_session(self, telegram_user_id: int) -> Optional[Dict[str, Any]]:
         """
-        Lấy token của người dùng từ database. API Logout cần token chính.
+        Lấy phiên đăng nhập (token, device UUID) của người dùng, đọc một lần cho mỗi update
         """
         try:
-            response_data = await self.db_manager.get_user_login_response(telegram_user_id)
-            if not response_data:
-                return None
-            
-            # API đăng xuất cần token chính
-            return response_data.get("token")
-
-        except Exception as e:
-            logger.error(f"Error getting token for user {telegram_user_id}: {e}")
-            return None
-    
-    async def _get_user_device_uuid(self, telegram_user_id: int) -> Optional[str]:
-        """
-        Lấy device UUID của người dùng từ database
-        
-        Args:
-            telegram_user_id: ID của người dùng trên Telegram
-            
-        Returns:
-            Device UUID của người dùng hoặc None nếu không tìm thấy
-        """
-        try:
-            user = await self.db_manager.get_user(telegram_user_id)
-            if user:
-                return user.get("device_uuid")
-            return None
+            return await self.db_manager.get_session(telegram_user_id)
         
         except Exception as e:
-            logger.error(f"Error getting device UUID for user {telegram_user_id}: {e}")
+            logger.error(f"Error getting session for user {telegram_user_id}: {e}")
             return None
     
     async def force_logout(self, telegram_user_id: int) -> Dict[str, Any]:
@@ -5,6 +5,7 @@
 Handler xử lý thời khóa biểu (TKB) từ hệ thống HUTECH
 """
 
+import asyncio
 import json
 import logging
 import aiohttp
@@ -15,14 +16,22 @@ import pytz
 import os
 
 from config.config import Config
+from cache.fetch_engine import non_empty_list
 
 logger = logging.getLogger(__name__)
 
 class TkbHandler:
-    def __init__(self, db_manager, cache_manager):
+    def __init__(self, db_manager, cache_manager, hutech_client, token_manager):
         self.db_manager = db_manager
         self.cache_manager = cache_manager
+        self.hutech_client = hutech_client
+        self.token_manager = token_manager
         self.config = Config()
+        
+        # Nguồn dữ liệu cho cache-aside dùng chung
+        self.cache_manager.fetch_engine.register(
+            "tkb", self._fetch_tkb, validate=non_empty_list, stale_ttl=self.config.CACHE_STALE_TTL
+        )
     
     async def handle_tkb(self, telegram_user_id: int, week_offset: int = 0) -> Dict[str, Any]:
         """
@@ -36,66 +45,30 @@ class TkbHandler:
             Dict chứa kết quả và dữ liệu thời khóa biểu
         """
         try:
-            # Tạo cache key
-            cache_key = f"tkb:{telegram_user_id}"
-
-            # 1. Kiểm tra cache trước
-            cached_result = await self.cache_manager.get(cache_key)
-            if cached_result:
-                # Xử lý dữ liệu từ cache
-                tkb_data = cached_result.get("data")
-                timestamp = cached_result.get("timestamp")
-                
-                processed_data = self._process_tkb_data(tkb_data, week_offset)
-                processed_data["timestamp"] = timestamp # Thêm timestamp vào dữ liệu đã xử lý
-
+            result = await self.cache_manager.fetch_engine.get_or_fetch(
+                "tkb", telegram_user_id, process=lambda tkb_data: self._process_tkb_data(tkb_data, week_offset)
+            )
+            
+            if result["success"]:
                 return {
                     "success": True,
-                    "message": "Lấy thời khóa biểu thành công",
-                    "data": processed_data,
+                    "message": "Lấy thời khóa biểu thành công" if result["from_cache"] else "Lấy thời khóa biểu thành công (dữ liệu mới)",
+                    "data": result["data"],
                     "week_offset": week_offset
                 }
-
-            # 2. Nếu cache miss, gọi API
-            token = await self._get_user_token(telegram_user_id)
             
-            if not token:
+            error = result["error"]
+            if error and error.get("not_logged_in"):
                 return {
                     "success": False,
-                    "message": "Bạn chưa đăng nhập. Vui lòng sử dụng /login để đăng nhập.",
+                    "message": error["message"],
                     "data": None
                 }
-            
-            response_data = await self._call_tkb_api(token)
-            
-            # 3. Lưu vào cache và database
-            if response_data and isinstance(response_data, list):
-                await self.cache_manager.set(cache_key, response_data, ttl=3600) # Cache trong 1 giờ
-                # await self._save_tkb_response(telegram_user_id, response_data, 0) # Đã chuyển sang Redis
-            
-            # Kiểm tra kết quả
-            if response_data and isinstance(response_data, list):
-                # Xử lý dữ liệu thời khóa biểu theo tuần
-                processed_data = self._process_tkb_data(response_data, week_offset)
-                # Lấy timestamp từ cache manager để đồng bộ
-                cached_data = await self.cache_manager.get(cache_key)
-                if cached_data:
-                    processed_data["timestamp"] = cached_data.get("timestamp")
-                else:
-                    processed_data["timestamp"] = datetime.utcnow().isoformat()
-
-                return {
-                    "success": True,
-                    "message": "Lấy thời khóa biểu thành công (dữ liệu mới)",
-                    "data": processed_data,
-                    "week_offset": week_offset
-                }
-            else:
-                return {
-                    "success": False,
-                    "message": "Không thể lấy dữ liệu thời khóa biểu",
-                    "data": response_data
-                }
+            return {
+                "success": False,
+                "message": "Không thể lấy dữ liệu thời khóa biểu",
+                "data": error
+            }
         
         except Exception as e:
             logger.error(f"TKB error for user {telegram_user_id}: {e}")
@@ -110,32 +83,20 @@ class TkbHandler:
         Xử lý yêu cầu xuất TKB ra file iCalendar (.ics).
         """
         try:
-            # 1. Lấy dữ liệu TKB (ưu tiên cache)
-            cache_key = f"tkb:{telegram_user_id}"
-            cached_result = await self.cache_manager.get(cache_key)
+            # 1. Lấy và xử lý toàn bộ dữ liệu TKB (ưu tiên cache)
+            result = await self.cache_manager.fetch_engine.get_or_fetch(
+                "tkb", telegram_user_id, process=self.get_all_tkb_data
+            )
             
-            tkb_raw_data = None
-            if cached_result:
-                tkb_raw_data = cached_result.get("data")
-            else:
-                token = await self._get_user_token(telegram_user_id)
-                if not token:
+            if not result["success"]:
+                error = result["error"]
+                if error and error.get("not_logged_in"):
                     return {"success": False, "message": "Bạn chưa đăng nhập."}
-                
-                response_data = await self._call_tkb_api(token)
-                if response_data and isinstance(response_data, list):
-                    await self.cache_manager.set(cache_key, response_data, ttl=3600)
-                    tkb_raw_data = response_data
-                else:
-                    return {"success": False, "message": "Không thể lấy dữ liệu TKB từ API."}
+                return {"success": False, "message": "Không thể lấy dữ liệu TKB từ API."}
 
-            if not tkb_raw_data:
-                return {"success": False, "message": "Không có dữ liệu TKB để xuất."}
+            all_tkb_data = result["data"]
 
-            # 2. Xử lý toàn bộ dữ liệu TKB
-            all_tkb_data = self.get_all_tkb_data(tkb_raw_data)
-
-            # 3. Tạo file .ics
+            # 2. Tạo file .ics
             file_path = self.create_ics_file(all_tkb_data, telegram_user_id)
 
             if file_path:
@@ -154,6 +115,19 @@ class TkbHandler:
             logger.error(f"ICS export error for user {telegram_user_id}: {e}")
             return {"success": False, "message": f"Lỗi khi xuất file: {str(e)}"}
     
+    async def _fetch_tkb(self, telegram_user_id: int) -> Optional[Dict[str, Any]]:
+        """
+        Lấy token và gọi API thời khóa biểu (nguồn dữ liệu của namespace "tkb")
+        
+        Args:
+            telegram_user_id: ID của người dùng trên Telegram
+            
+        Returns:
+            Response data từ API hoặc NOT_LOGGED_IN
+        """
+        # Token hết hạn (401) được làm mới và gọi lại một lần
+        return await self.token_manager.call(telegram_user_id, self._call_tkb_api)
+    
     async def _call_tkb_api(self, token: str) -> Optional[Dict[str, Any]]:
         """
         Gọi API thời khóa biểu của HUTECH
@@ -165,29 +139,34 @@ class TkbHandler:
             Response data từ API hoặc None nếu có lỗi
         """
         try:
-            url = f"{self.config.HUTECH_API_BASE_URL}{self.config.HUTECH_TKB_ENDPOINT}"
-            
             # Tạo headers riêng cho API thời khóa biểu
             headers = self.config.HUTECH_MOBILE_HEADERS.copy()
             headers["authorization"] = f"JWT {token}"
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    url,
-                    headers=headers,
-                    json={}  # Request body rỗng theo tài liệu
-                ) as response:
-                    if response.status == 201:
-                        return await response.json()
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"TKB API error: {response.status} - {error_text}")
-                        return {
-                            "error": True,
-                            "status_code": response.status,
-                            "message": error_text
-                        }
+            async with self.hutech_client.request(
+                "POST",
+                self.config.HUTECH_TKB_ENDPOINT,
+                headers=headers,
+                json={}  # Request body rỗng theo tài liệu
+            ) as response:
+                if response.status == 201:
+                    return await response.json()
+                else:
+                    error_text = await response.text()
+                    logger.error(f"TKB API error: {response.status} - {error_text}")
+                    return {
+                        "error": True,
+                        "status_code": response.status,
+                        "message": error_text
+                    }
         
+        except asyncio.TimeoutError:
+            logger.error("HUTECH API timeout")
+            return {
+                "error": True,
+                "timeout": True,
+                "message": "Hệ thống HUTECH phản hồi quá chậm, vui lòng thử lại sau."
+            }
         except aiohttp.ClientError as e:
             logger.error(f"HTTP client error: {e}")
             return {
@@ -208,27 +187,6 @@ class TkbHandler:
             }
     
     
-    async def _get_user_token(self, telegram_user_id: int) -> Optional[str]:
-        """
-        Lấy token của người dùng từ database (ưu tiên token từ old_login_info cho các API cũ).
-        """
-        try:
-            response_data = await self.db_manager.get_user_login_response(telegram_user_id)
-            if not response_data:
-                return None
-
-            # Ưu tiên sử dụng token từ old_login_info cho các API elearning cũ
-            old_login_info = response_data.get("old_login_info")
-            if isinstance(old_login_info, dict) and old_login_info.get("token"):
-                return old_login_info["token"]
-            
-            # Nếu không, sử dụng token chính
-            return response_data.get("token")
-
-        except Exception as e:
-            logger.error(f"Error getting token for user {telegram_user_id}: {e}")
-            return None
-    
     def get_all_tkb_data(self, tkb_data: List[Dict[str, Any]]) -> Dict[str, Any]:
         """
         Xử lý và trả về toàn bộ dữ liệu TKB có lịch học chi tiết.
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Deadline cho từng update Telegram, được truyền qua handler, cache, database và API HUTECH
+"""
+
+import asyncio
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+# Thời điểm hết hạn (theo time.monotonic()) của update đang xử lý, None nếu không giới hạn
+_deadline: ContextVar[Optional[float]] = ContextVar("update_deadline", default=None)
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    """Lỗi khi update đã hết thời gian xử lý cho phép."""
+
+def set_deadline(seconds: Optional[float]) -> None:
+    """
+    Đặt deadline cho context hiện tại.
+
+    Args:
+        seconds: Số giây kể từ bây giờ, None để bỏ giới hạn (dùng cho tác vụ nền)
+    """
+    _deadline.set(time.monotonic() + seconds if seconds is not None else None)
+
+def remaining() -> Optional[float]:
+    """Số giây còn lại trước deadline, None nếu không có deadline."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+def budget(timeout: float) -> float:
+    """
+    Tính thời gian chờ cho một thao tác: không vượt quá timeout riêng của thao tác
+    và không vượt quá thời gian còn lại của update.
+
+    Args:
+        timeout: Timeout riêng của thao tác (giây)
+
+    Returns:
+        Số giây được phép chờ
+
+    Raises:
+        DeadlineExceeded: Nếu update đã hết thời gian.
+    """
+    left = remaining()
+    if left is None:
+        return timeout
+    if left <= 0:
+        raise DeadlineExceeded("Đã hết thời gian xử lý yêu cầu.")
+    return min(timeout, left)